@@ -1,10 +1,19 @@
 import os
+import re
+import base64
+import logging
+import argparse
+from urllib.parse import urlencode
 import numpy as np
 import pandas
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-from dash import Dash, dcc, html, Input, Output
-import dash_table
+
+from snip_calling import (pathway, LRUCache, convert_harv_processed, profiles_path, load_profiles, profile_for,
+                          pinned_files, file_chromosomes, file_key, file_derived,
+                          chromosome_snps, chromosome_window, peaks_by_lod, normalize_inputs, called_snps, display_values,
+                          export_formats, export_chunks, parsed_files, called_results, cache_memory_budget)
+import snip_metrics
+from snip_metrics import timed
+from snip_catalog import Catalog
 
 
 """
@@ -18,163 +27,741 @@ The dashboard bridges GEMMA (GWAS pipeline, https://github.com/genetics-statisti
 (GWAS peak calling tool, https://genomics.ut.ee/en/tools) to visualise the association peaks in interactive way, 
 with additional feature to include parameters to filter the noise and yield strict and objective peak calling. 
 
+The loading and peak calling live in snip_calling. Importing this module has no side effects, plotly and dash
+are imported when the app is created (create_app) or a figure is built. Running this module starts the
+single-process development server, snip_serve serves the app with several worker processes.
+
+Numeric arrays of the figures are sent as base64 typed arrays (see typed_array), the rest of the callback
+responses is encoded by plotly's JSON encoder, which uses orjson when it is installed. Typed arrays need
+plotly (plotly.py) 6 or newer, whose graph objects accept them, and a Dash release serving plotly.js 2.28
+or newer, which decodes them. With older versions the arrays are sent as JSON lists (see typed_arrays_supported).
+
 """
 
 
 
-# path to the directory with har_processed files
-pathway = "harv_processed/"
+# traces added per chromosome to the Manhattan plot:
+# not called, harvester called, called
+TRACES_PER_CHROMOSOME = 3
+BACKGROUND_TRACE = 0
+CALLED_TRACE = 2
+
+# layout shapes of the Manhattan plot: horizontal noise and bonferroni lines across all chromosomes
+NOISE_SHAPE = 0
+BONFERRONI_SHAPE = 1
+
+# layout of the Manhattan plot: "subplots" draws one subplot per chromosome of the file's genome profile
+# with TRACES_PER_CHROMOSOME traces each, "cumulative" draws all chromosomes found in the file one after
+# another on a single x-axis, with one trace per category (the traces of the first subplot)
+figure_layout = "subplots"
+# alternating colors of the "not called" SNPs of neighbouring chromosomes in the cumulative layout
+cumulative_colors = ("gray", "darkgray")
+# horizontal space between the subplots of the subplots layout (fraction of the figure width)
+subplot_spacing = 0.01
+
+# construction of the figures: "dict" assembles them as plain dictionaries (figure_dict), "plotly"
+# with plotly graph objects (plotly_figure), which validate every property but are much slower
+figure_builder = "dict"
+# layout template of the figures, see figure_template
+_template = None
+# whether the installed plotly and Dash support base64 typed arrays, see typed_arrays_supported
+_typed_arrays = None
+# colorscale of the harvester called SNPs by GQS: plotly's "Viridis_r" spelled out, since plotly.js
+# only knows the scale names without the "_r" suffix that graph objects expand
+GQS_COLORSCALE = [[i / 9, color] for i, color in enumerate(
+    ("#fde725", "#b5de2b", "#6ece58", "#35b779", "#1f9e89", "#26828e", "#31688e", "#3e4989", "#482878", "#440154"))]
+
+# rendering of the Manhattan plot traces: "auto" draws traces with more than webgl_min_points
+# points with WebGL (go.Scattergl) and smaller ones as SVG (go.Scatter), "svg" and "webgl"
+# force one of the two for all traces
+render_mode = "auto"
+webgl_min_points = 100000
+
+# thinning of the "not called" background trace: all SNPs with LOD of at least thin_lod_floor
+# are drawn, of the SNPs below it only one per cell of a thin_bins (position x LOD) grid over
+# the chromosome, which is about the resolution of the markers on screen
+thin_background = True
+thin_lod_floor = 2.0
+thin_bins = (300, 100)
+# zoomed-in chromosome windows are drawn at full resolution up to this number of SNPs
+# (and thinned like the whole chromosome above it)
+detail_max_points = 100000
+
+# hover text of the harvester called and called SNPs, see peak_customdata
+peak_hovertemplate = ("<br>pos: %{x}<br>" +
+                      "<br>LOD: %{y}<br>" +
+                      "<br>GQS: %{customdata[0]}<br>" +
+                      "<br>spac: %{customdata[1]}<br>" +
+                      "<br>count: %{customdata[2]}<br>" +
+                      "<br>monot: %{customdata[3]}<br>" +
+                      "<br>vbal1: %{customdata[4]}<br>")
+# the same in the cumulative layout, where x is the position on the whole genome: the chromosome and
+# the position within it are added to the customdata (see peak_customdata)
+cumulative_peak_hovertemplate = ("<br>chr: %{customdata[6]}<br>" +
+                                 "<br>pos: %{customdata[5]}<br>" +
+                                 "<br>LOD: %{y}<br>" +
+                                 "<br>GQS: %{customdata[0]}<br>" +
+                                 "<br>spac: %{customdata[1]}<br>" +
+                                 "<br>count: %{customdata[2]}<br>" +
+                                 "<br>monot: %{customdata[3]}<br>" +
+                                 "<br>vbal1: %{customdata[4]}<br>")
+
+# values of the "Top avg" dropdown: the averages of the top 5 to 10 peaks in the averages line
+top_avg_values = range(6)
+
+# files offered at a time in the filename dropdown, the others are found by typing (see update_file_options)
+dropdown_matches = 50
+
+# rows per page of the called SNPs table, and number of its filtered/sorted views kept
+table_page_size = 25
+table_view_cache_size = 16
+
+# operators of the DataTable filter_query syntax, longest first
+filter_operators = (("ge ", ">="), ("le ", "<="), ("lt ", "<"), ("gt ", ">"), ("ne ", "!="), ("eq ", "="),
+                    ("contains ",), ("datestartswith ",))
+filter_comparisons = {"lt": np.less, "le": np.less_equal, "gt": np.greater, "ge": np.greater_equal,
+                      "ne": np.not_equal, "eq": np.equal}
+
+# serve /metrics only to requests from the local machine
+metrics_local_only = True
+
+# number of figures kept for returning to previously selected files and inputs
+figure_cache_size = 8
+
+# Manhattan plot figures, keyed by file, (mtime, size), the normalized app inputs and the drawing settings
+figures = LRUCache(figure_cache_size)
+
+# filtered and sorted called SNPs tables, keyed by the called_snps key, filter_query and sort_by
+table_views = LRUCache(table_view_cache_size)
+
+# chromosome placements of the cumulative layout (see cumulative_axis), keyed by file, (mtime, size) and genome profile
+cumulative_axes = LRUCache(figure_cache_size)
+
+logger = logging.getLogger(__name__)
+
+# harv_processed files of pathway offered in the filename dropdown, kept up to date by create_app
+# (its database is local to the server, see snip_catalog)
+catalog = Catalog(pathway)
+
+
+def thin_snps(df_chr, lod_floor, bins):
+    """
+    Thins the SNPs of a chromosome for drawing.
+
+        Inputs:
+    df_chr: SNPs of one chromosome.
+    lod_floor: SNPs with LOD of at least lod_floor are all kept.
+    bins: (position bins, LOD bins) of the grid over the chromosome and LODs 0..lod_floor,
+    of the SNPs below lod_floor only the first one in each grid cell is kept.
+
+        Outputs:
+    df_chr reduced to the kept SNPs, in the original order.
+    """
+    ps = df_chr["ps"].to_numpy().astype(np.int64)
+    lod = df_chr["LOD"].to_numpy()
+    low = np.flatnonzero(lod < lod_floor)
+    if len(low) == 0:
+        return df_chr
+
+    ps_min = ps.min()
+    x = (ps[low] - ps_min) * bins[0] // (ps.max() - ps_min + 1)
+    y = np.clip((lod[low] / lod_floor * bins[1]).astype(np.int64), 0, bins[1] - 1)
+    _, first = np.unique(x * bins[1] + y, return_index=True)
+
+    keep = np.sort(np.concatenate([np.flatnonzero(lod >= lod_floor), low[first]]))
+    return df_chr.iloc[keep]
+
+
+def background_snps(file):
+    """
+    SNPs drawn in the "not called" trace of each chromosome (position and LOD), thinned by
+    thin_snps when thin_background is set. Computed once per loaded file, see file_derived.
+    """
+    def build(df_trim):
+        background = {}
+        for chromosome in file_chromosomes(file):
+            df_chr = chromosome_snps(file, chromosome)[["ps", "LOD"]]
+            background[chromosome] = thin_snps(df_chr, thin_lod_floor, thin_bins) if thin_background else df_chr
+        return background
+
+    return file_derived(file, ("background", thin_background, thin_lod_floor, thin_bins), build)
+
+
+def selected_file(filen):
+    """Path of the harv_processed file selected in the filename dropdown."""
+    if type(filen) != list:
+        return pathway + filen
+    else:
+        return pathway + filen[-1]
+
+
+def peak_customdata(dff, cumulative=False):
+    """
+    Peak parameters shown when hovering over the harvester called and called SNPs (see display_values), as a
+    typed_array. In the cumulative layout followed by the position (ps) and the chromosome of the SNPs.
+    """
+    columns = ["GQS", "spacing","count","monot","vbal1"] + (["ps", "chr"] if cumulative else [])
+    return typed_array(display_values(dff[columns]).to_numpy())
+
+
+def _version(version):
+    """(major, minor) of a version string like "2.28.0"."""
+    return tuple(int(part) for part in re.findall(r"\d+", version)[:2])
+
+
+def plotlyjs_version():
+    """
+    Version of the plotly.js that Dash serves to the browser, or None when it cannot be found.
+    Dash 3 serves the plotly.js bundled with plotly.py, older releases their own copy in dash.dcc.
+    """
+    import dash
+
+    if hasattr(dash.Dash, "_setup_plotlyjs"):
+        from plotly.offline import get_plotlyjs_version
+        return get_plotlyjs_version()
+
+    directory = os.path.join(os.path.dirname(dash.__file__), "dcc")
+    for name in sorted(os.listdir(directory)):
+        if "plotly" in name and name.endswith((".js", ".txt")):
+            with open(os.path.join(directory, name), errors="replace") as handle:
+                match = re.search(r"plotly\.js v(\d+\.\d+\.\d+)", handle.read())
+            if match:
+                return match.group(1)
+    return None
+
+
+def typed_arrays_supported():
+    """
+    Whether figures can carry base64 typed arrays (see typed_array): plotly 6 or newer, and plotly.js
+    2.28 or newer served by Dash. Checked once, a warning is logged when they are not supported.
+    """
+    global _typed_arrays
+
+    if _typed_arrays is None:
+        import plotly
+
+        plotlyjs = plotlyjs_version()
+        _typed_arrays = _version(plotly.__version__) >= (6, 0) and plotlyjs is not None and _version(plotlyjs) >= (2, 28)
+        if not _typed_arrays:
+            logger.warning("figure arrays are sent as JSON lists: base64 typed arrays need plotly >= 6 and "
+                           "plotly.js >= 2.28 (found plotly %s, plotly.js %s)", plotly.__version__, plotlyjs or "unknown")
+    return _typed_arrays
+
+
+def typed_array(values):
+    """
+    Numeric array in the base64 typed-array form read by plotly.js ({"dtype", "bdata", "shape"}),
+    sent as raw little-endian bytes instead of a JSON list of numbers, which is several times
+    smaller and faster to encode and decode.
+
+        Inputs:
+    values: 1-D or 2-D array-like of numbers (e.g. a column of a data frame).
+
+        Outputs:
+    dictionary usable wherever plotly.js expects a data array (x, y, marker.color, customdata).
+    64-bit integers are narrowed to 32 bits when they fit, since plotly.js has no 64-bit
+    integer arrays, and sent as float64 otherwise; booleans are sent as uint8.
+    A (nested) list of the values when typed arrays are not supported, see typed_arrays_supported.
+    """
+    values = np.asarray(values)
+    if not typed_arrays_supported():
+        return values.tolist()
+    if values.dtype.kind == "b":
+        values = values.astype(np.uint8)
+    elif values.dtype.kind in "iu" and values.dtype.itemsize > 4:
+        low, high = (values.min(), values.max()) if values.size else (0, 0)
+        if 0 <= low and high <= np.iinfo(np.uint32).max:
+            values = values.astype(np.uint32)
+        elif np.iinfo(np.int32).min <= low and high <= np.iinfo(np.int32).max:
+            values = values.astype(np.int32)
+        else:
+            values = values.astype(np.float64)
+    elif values.dtype.kind == "f" and values.dtype.itemsize < 4:
+        values = values.astype(np.float32)
+    values = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("<"))
+
+    array = {"dtype": "%s%d" % (values.dtype.kind, values.dtype.itemsize),
+             "bdata": base64.b64encode(values.tobytes()).decode("ascii")}
+    if values.ndim > 1:
+        array["shape"] = ", ".join(str(n) for n in values.shape)
+    return array
+
+
+def scatter_type(n_points):
+    """Plotly trace type ("scatter" or "scattergl", drawn with WebGL) of a trace of n_points points, see render_mode."""
+    if render_mode == "webgl" or (render_mode == "auto" and n_points > webgl_min_points):
+        return "scattergl"
+    return "scatter"
+
+
+def zoomed_windows(relayout, columns):
+    """
+    Chromosome windows changed by a zoom of the Manhattan plot.
+
+        Inputs:
+    relayout: relayoutData of the man_plot graph.
+    columns: number of subplots (x-axes) of the figure.
+
+        Outputs:
+    dictionary column: (start, end) of the zoomed x-axis range of the subplot, or None
+    when the axis of the subplot was reset (autorange).
+    """
+    windows = {}
+    for column in range(1, columns + 1):
+        axis = "xaxis" if column == 1 else "xaxis%d" % column
+        if relayout.get(axis + ".autorange"):
+            windows[column] = None
+        elif axis + ".range[0]" in relayout:
+            windows[column] = (relayout[axis + ".range[0]"], relayout[axis + ".range[1]"])
+        elif axis + ".range" in relayout:
+            windows[column] = tuple(relayout[axis + ".range"])
+    return windows
+
+
+def background_trace_index(column):
+    """Index of the "not called" trace of the chromosome in a subplot column (from 1) of the Manhattan plot figure."""
+    return (column - 1) * TRACES_PER_CHROMOSOME + BACKGROUND_TRACE
+
+
+def called_trace_index(column):
+    """Index of the "called" trace of the chromosome in a subplot column (from 1) of the Manhattan plot figure."""
+    return (column - 1) * TRACES_PER_CHROMOSOME + CALLED_TRACE
+
+
+def threshold_shapes(noise_border, bonferroni_border):
+    """
+    Layout shapes of the noise and Bonferroni thresholds (in the order of NOISE_SHAPE and BONFERRONI_SHAPE):
+    dashed horizontal lines across the whole plot, at the LOD of the threshold on the shared y-axis.
+    """
+    return [dict(type="line", xref="paper", x0=0, x1=1, yref="y", y0=border, y1=border,
+                 line=dict(color=color, width=2, dash="dash"))
+            for border, color in ((noise_border, "royalblue"), (bonferroni_border, "red"))]
 
-# names of chromosomes  for the studied species
-chromosomes_list = ("Chromosome 1", "Chromosome 2", "Chromosome 3", "Chromosome 4", "Chromosome 5")
 
+def cumulative_axis(file):
+    """
+    Placement of the chromosomes of a harv_processed file on the single x-axis of the cumulative layout.
+    Memoized in cumulative_axes by file_key, so threshold edits find it without loading the file again.
 
-def read_harv_processed(file):
+        Outputs:
+    dictionary chromosome: (offset, end), in the order of file_chromosomes; a position ps of the
+    chromosome is drawn at offset + ps, the chromosome ends at end. A chromosome spans its length
+    in the file's GenomeProfile, or up to its last SNP when that is further (or the length is unknown),
+    so SNPs beyond the profile's length never land on the next chromosome. Chromosomes with neither
+    a length nor SNPs are left out.
+    """
+    profile = profile_for(file)
+    key = file_key(file) + (profile.name,)
+    axis = cumulative_axes.get(key)
+    if axis is None:
+        axis, offset = {}, 0
+        for chromosome in file_chromosomes(file):
+            ps = chromosome_snps(file, chromosome)["ps"].to_numpy()
+            span = max(profile.lengths.get(chromosome, 0), int(ps[-1]) if len(ps) else 0)
+            if span:
+                axis[chromosome] = (offset, offset + span)
+                offset += span
+        cumulative_axes.put(key, axis)
+    return axis
+
+
+def cumulative_snps(file, frames):
     """
+    SNPs of several chromosomes for a trace of the cumulative layout.
+
         Inputs:
     file: harv_processed file from a given pathway.
+    frames: dictionary chromosome: SNPs of the chromosome (with the ps column).
 
         Outputs:
-    averages: the list generated from the first line of harv_processed
-    file (average LODs of top 5-10 peaks).
+    the SNPs of all chromosomes concatenated in the order of cumulative_axis, with two added
+    columns: x, the position on the cumulative axis, and shade, 0 or 1 alternating between
+    neighbouring chromosomes.
+    """
+    parts = []
+    for rank, (chromosome, (offset, _)) in enumerate(cumulative_axis(file).items()):
+        df = frames.get(chromosome)
+        if df is not None and len(df):
+            parts.append(df.assign(x=df["ps"].to_numpy().astype(np.int64) + offset, shade=rank % 2))
+    if not parts:  # no SNPs, keep the columns of the frames
+        empty = next(iter(frames.values()), pandas.DataFrame({"ps": [], "LOD": []}))
+        return empty.iloc[:0].assign(x=np.empty(0, dtype=np.int64), shade=np.empty(0, dtype=np.int64))
+    return pandas.concat(parts, ignore_index=True)
+
+
+def splice_window(df_back, df_window, start, end):
+    """
+    SNPs of a chromosome drawn in its "not called" trace for a zoomed window: the thinned SNPs df_back
+    (see background_snps) before start and after end, and the SNPs df_window in between (both sorted by ps).
+    """
+    ps = df_back["ps"].to_numpy()
+    return pandas.concat([df_back.iloc[:np.searchsorted(ps, start, side="left")],
+                          df_window,
+                          df_back.iloc[np.searchsorted(ps, end, side="right"):]])
+
+
+def cumulative_window(file, window):
+    """
+    SNPs drawn in the "not called" trace of the cumulative layout for a zoomed x-axis window
+    (None when the axis was reset): all SNPs in the window, thinned again if there are more than
+    detail_max_points, and the thinned SNPs (see background_snps) elsewhere.
+    """
+    background = background_snps(file)
+    if window is None:
+        return cumulative_snps(file, background)
+
+    frames = dict(background)
+    detail = {}
+    for chromosome, (offset, end) in cumulative_axis(file).items():
+        if offset <= window[1] and window[0] <= end:
+            start, stop = window[0] - offset, window[1] - offset
+            detail[chromosome] = (start, stop, chromosome_window(file, chromosome, start, stop)[["ps", "LOD"]])
+    if sum(len(df) for _, _, df in detail.values()) > detail_max_points:
+        detail = {chromosome: (start, stop, thin_snps(df, thin_lod_floor, thin_bins))
+                  for chromosome, (start, stop, df) in detail.items()}
+    for chromosome, (start, stop, df) in detail.items():
+        frames[chromosome] = splice_window(background[chromosome], df, start, stop)
+    return cumulative_snps(file, frames)
+
+
+def background_trace(df_back, cumulative=False):
+    """
+    "not called" trace, as a dictionary of plotly trace properties, of the SNPs in df_back: gray markers,
+    or in the cumulative layout (df_back from cumulative_snps) markers alternating between cumulative_colors
+    which show the position within the chromosome when hovered.
+    """
+    trace = dict(type=scatter_type(len(df_back)),
+                 y=typed_array(df_back["LOD"]),
+                 name='not called',
+                 mode='markers')
+    if cumulative:
+        trace.update(x=typed_array(df_back["x"]),
+                     customdata=typed_array(df_back["ps"]),
+                     hovertemplate="<br>pos: %{customdata}<br>" + "<br>LOD: %{y}<br>",
+                     marker=dict(color=typed_array(df_back["shade"]),
+                                 colorscale=[[0, cumulative_colors[0]], [1, cumulative_colors[1]]],
+                                 cmin=0,
+                                 cmax=1,
+                                 size=5))
+    else:
+        trace.update(x=typed_array(df_back["ps"]),
+                     hovertemplate="<br>pos: %{x}<br>" + "<br>LOD: %{y}<br>",
+                     marker=dict(color='gray', size=5))
+    return trace
+
 
-    df (pandas data frame) containing the GEMMA (GWAS pipeline) and harvester
-    combined information about SNPs and parameters in their allocated peaks.
+def peak_traces(dff_harvester, dff_called, cumulative=False):
     """
-    with open(file) as file:
-        line = file.readline().strip()
-        averages = line.split("\t")
-        df = pandas.read_csv(file, sep="\t")
-        return df, averages
+    "harvester called" and "called" traces, as dictionaries of plotly trace properties, of the harvester
+    called SNPs and of the called SNPs, drawn at their positions (ps), or in the cumulative layout
+    (dff_harvester and dff_called from cumulative_snps) at their positions on the cumulative axis (x).
 
+    WebGL is picked for both from the number of harvester called SNPs, since the called trace
+    only ever shows a subset of them (and keeps its type when update_thresholds replaces it).
+    """
+    trace_type = scatter_type(len(dff_harvester))
+    x = "x" if cumulative else "ps"
+    hovertemplate = cumulative_peak_hovertemplate if cumulative else peak_hovertemplate
+
+    harvester = dict(type=trace_type,
+                     x=typed_array(dff_harvester[x]),
+                     y=typed_array(dff_harvester["LOD"]),
+                     customdata=peak_customdata(dff_harvester, cumulative),
+                     hovertemplate=hovertemplate,
+                     mode='markers',
+                     name='harvester called',
+                     marker=dict(color=typed_array(dff_harvester["GQS"]),
+                                 colorscale=GQS_COLORSCALE,
+                                 cmin=2,
+                                 cmax=5,
+                                 colorbar=dict(x=- 0.11,
+                                               title=dict(text="GQS"),
+                                               tickvals=[2, 3, 4, 5],
+                                               ticktext=["2", "3", "4", "5"]),
+                                 size=5))
+
+    called = dict(type=trace_type,
+                  x=typed_array(dff_called[x]),
+                  y=typed_array(dff_called["LOD"]),
+                  customdata=peak_customdata(dff_called, cumulative),
+                  hovertemplate=hovertemplate,
+                  mode='markers',
+                  name='called',
+                  marker=dict(color='red', size=5))
+
+    return harvester, called
+
+
+def subplots_traces(file, result):
+    """
+    Traces of the subplots layout: list of (subplot column, trace) with the traces of each chromosome
+    in the order given by TRACES_PER_CHROMOSOME and CALLED_TRACE, update_thresholds relies on it.
+    """
+    background = background_snps(file)
+    peaks = peaks_by_lod(file)
 
+    traces = []
+    for column, chromosome in enumerate(profile_for(file).chromosomes, start=1):
+        traces.append((column, background_trace(background[chromosome])))
+        for trace in peak_traces(peaks[chromosome][0], result["called"][chromosome]):
+            traces.append((column, trace))
+    return traces
 
-# make list of all harv_processed files in the given directory
-files = [f for f in os.listdir(pathway) if os.path.isfile(os.path.join(pathway, f))  and "harv_processed" in f]
 
+def cumulative_traces(file, result):
+    """Traces of the cumulative layout, in the order of the traces of the first subplot of the subplots layout."""
+    peaks = peaks_by_lod(file)
+    df_back = cumulative_snps(file, background_snps(file))
+    dff_harvester = cumulative_snps(file, {chromosome: peaks[chromosome][0] for chromosome in peaks})
+    dff_called = cumulative_snps(file, result["called"])
+    return [background_trace(df_back, cumulative=True)] + list(peak_traces(dff_harvester, dff_called, cumulative=True))
 
-# app layout written with Dash, renders in HTML.
-app = Dash(__name__)
-app.layout = html.Div([
 
-    html.H1("Semi-Natural Intelligence Peak calling (SNIP calling)", style = {'text-align':'center', "font-family":"Arial"}),
-    html.H2("Interactive dashboard for visualising GWAS output", style = {'text-align':'center', "font-family":"Arial"}),
+def cumulative_xaxis(file):
+    """x-axis of the cumulative layout: the whole genome, with the chromosome names at their middle."""
+    axis = cumulative_axis(file)
+    return dict(tickvals=[(offset + end) / 2 for offset, end in axis.values()],
+                ticktext=[profile_for(file).chromosome_name(chromosome) for chromosome in axis],
+                range=[0, max([end for _, end in axis.values()], default=0)])
 
 
-        html.Br(),
-        html.Div(className="row", children = [
-
-        html.Div([html.Label("Select file")], style = {"width":'48%', "font-family":"Arial", 'margin-left': "14%"}) ,
-           html.Div([html.Label("Peaks")], style = {"width":'25%', "font-family":"Arial", 'margin-left': "-22.5%"}) ,
-           html.Div([html.Label("Factor")],style = {"width":'6%', "font-family":"Arial", 'margin-left': "-16.15%"})  ,
-           html.Div([html.Label("Min SNPs")], style = {"width":'6%', "font-family":"Arial", 'margin-left': "3.6%"}) ,
-           html.Div([html.Label("Max spacing")], style = {"width":'6%', "font-family":"Arial", 'margin-left': "3.5%"}),
-           html.Div([html.Label("Min vbal")], style = {"width":'6%', "font-family":"Arial", 'margin-left': "3.4%"})
-        ], style = {"display" : "flex", "margin-top" : "1%" }),
-
-        html.Div( className="row",children = [
-
-        # html.Button('Next', id='next_button'),                          ###### to add
-
-        html.Div(dcc.Dropdown(id='filename',
-                     options=[
-                         {'label': i, 'value': i} for i in files
-                     ],
-                     multi=False,
-                     style = {"width":"80%", "margin-left":"0%"},
-                     value = files[0]
-
-                     ), style = {"width":"35%", "margin-left":"14%"}),
-
-        html.Div(dcc.Dropdown(id="Top avg",
-                     options=[
-                              {"label":"5","value":0},
-                              {"label":"6","value":1},
-                              {"label":"7","value":2},
-                              {"label":"8","value":3},
-                              {"label":"9","value":4},
-                              {"label":"10","value":5}
-                              ],
-
-                     multi = False,
-                     value= 0,
-                     ), style = {"width":"6%", "margin-left":"-9.7%", "margin-right":"-0%"}),
-
-        dcc.Input(id="factor",
-                  type = "number",
-                  style = {"width":"6%",'margin-left': "3%"},
-                  value= 1.33
-                     ),
-
-        dcc.Input(id="peak_count",
-                  type = "number",
-                  style={"width":"6%",'margin-left': "3%"},
-                  # size = "2",
-                  value = 50,
-                  ),
-
-        dcc.Input(id="max_spacing",
-                  type = "number",
-                  style={"width":"6%",'margin-left': "3%"},
-                  value = 20000,
-                  ),
-        dcc.Input(id="min_vbal",
-                  type = "number",
-                  style={"width":"6%",'margin-left': "3%"},
-                  value = 0.1,
-                  )
-        ], style = dict(display = "flex",margin_bottom = "-10%")),
-
-
-    dcc.Graph(id='man_plot', figure = {}, style={'width': '100%', 'height': '75vh', "margin_top":"-70%"}),
-
-    html.Br(),
-    html.H3("Parameters of called SNPs",
-            style = {'text-align':'center', "font-family":"Arial"}),
-
-    dash_table.DataTable(id="called_table",
-                         style_cell={
-                             'overflow': 'hidden',
-                             'textOverflow': 'ellipsis',
-                             'maxWidth': 0,
-                              "font-family":"Arial",
-                              'text-align':'center'
-                         },
-                         style_table={"width":"95%",
-                                      "margin-left":"2.5%"}
-                         ),
-    html.Div(id= "output_container", children =[]),
-])
+def subplot_axes(titles, spacing=subplot_spacing):
+    """
+    Axes and subplot titles of one row of subplots sharing the y-axis, one subplot per title,
+    as laid out by plotly's make_subplots(rows=1, cols=len(titles), shared_yaxes=True,
+    horizontal_spacing=spacing, subplot_titles=titles).
+
+        Outputs:
+    layout properties: xaxis, yaxis, xaxis2, yaxis2, ... (the axes of subplot column n are
+    referred to as xn and yn by its traces, x and y for the first one) and annotations.
+    """
+    width = (1 - spacing * (len(titles) - 1)) / len(titles)
+    layout = {"annotations": []}
+    for column, title in enumerate(titles, start=1):
+        suffix = "" if column == 1 else str(column)
+        start = (column - 1) * (width + spacing)
+        end = min(start + width, 1.0)
+
+        layout["xaxis" + suffix] = dict(anchor="y" + suffix, domain=[start, end])
+        layout["yaxis" + suffix] = dict(anchor="x" + suffix, domain=[0.0, 1.0])
+        if column > 1:
+            layout["yaxis" + suffix].update(matches="y", showticklabels=False)
+        layout["annotations"].append(dict(font=dict(size=16), showarrow=False, text=title,
+                                          x=(start + end) / 2, xanchor="center", xref="paper",
+                                          y=1.0, yanchor="bottom", yref="paper"))
+    return layout
+
+
+def figure_template():
+    """Layout template of the plotly default theme (as a dictionary), which graph objects figures get implicitly."""
+    global _template
+
+    if _template is None:
+        import plotly.io as pio
+        _template = pio.templates[pio.templates.default].to_plotly_json()
+    return _template
+
+
+def figure_uirevision(file):
+    """
+    uirevision of the Manhattan plot layout: the file name, so the zoom of the user is kept by the
+    partial updates (Patch) of update_thresholds and update_detail, and reset when another file is selected.
+    """
+    return os.path.basename(file)
+
 
-def handle_inputs(input, new_type = int, default_value = 0):
+def figure_dict(file, result):
     """
-    function which handles the app dcc.input values and returns them in desired type/format.
-    Handles dcc.input of type number. If input is not given, default value is returned.
+    Manhattan plot of a harv_processed file as a plain figure dictionary, assembled from the trace
+    and axis properties directly, without the validation and copies of plotly graph objects.
+    Gives the same figure as plotly_figure, see figure_builder.
     """
-    if input is not None and len(str(input)) > 0:
-         return new_type(input)
+    layout = dict(template=figure_template(),
+                  showlegend=False,
+                  uirevision=figure_uirevision(file),
+                  shapes=threshold_shapes(result["noise_border"], result["bonferroni"]))
+
+    if figure_layout == "cumulative":
+        data = cumulative_traces(file, result)
+        layout.update(xaxis=cumulative_xaxis(file), yaxis={})
     else:
-        return default_value
-
-# ------------------------------------------------------------------------------
-# App callback that connects the graph/table with input Dash components
-@app.callback(
-    [Output(component_id='output_container', component_property='children'),
-     Output(component_id='man_plot', component_property='figure'),
-     Output(component_id="called_table",component_property="data"),
-     Output(component_id="called_table", component_property = "columns")
-     ],
-    [Input(component_id="filename",component_property="value"),
-    Input(component_id='Top avg', component_property='value'),
-    Input(component_id='factor',component_property='value'),
-    Input(component_id='peak_count',component_property='value'),
-    Input(component_id='max_spacing',component_property='value'),
-    Input(component_id='min_vbal',component_property='value')
-    ])
+        profile = profile_for(file)
+        layout.update(subplot_axes([profile.chromosome_name(chromosome) for chromosome in profile.chromosomes]))
+        data = []
+        for column, trace in subplots_traces(file, result):
+            suffix = "" if column == 1 else str(column)
+            data.append(dict(trace, xaxis="x" + suffix, yaxis="y" + suffix))
+
+    layout["yaxis"]["title"] = dict(text="-log10(p-value)")
+    return {"data": data, "layout": layout}
+
+
+def plotly_figure(file, result):
+    """
+    Manhattan plot of a harv_processed file built with plotly graph objects (make_subplots and
+    add_trace), which validate every property. Slower than figure_dict, for debugging, see figure_builder.
+    """
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    if figure_layout == "cumulative":
+        fig = go.Figure(data=cumulative_traces(file, result))
+        fig.update_layout(xaxis=cumulative_xaxis(file))
+    else:
+        profile = profile_for(file)
+        fig = make_subplots(rows = 1,
+                            cols = len(profile.chromosomes),
+                            shared_yaxes = True,
+                            horizontal_spacing = subplot_spacing,
+                            subplot_titles=[profile.chromosome_name(chromosome) for chromosome in profile.chromosomes])
+        for column, trace in subplots_traces(file, result):
+            fig.add_trace(trace, row=1, col=column)
+
+    fig.update_layout(showlegend=False, yaxis_title="-log10(p-value)", uirevision=figure_uirevision(file),
+                      shapes=threshold_shapes(result["noise_border"], result["bonferroni"]))
+    return fig
+
+
+def manhattan_figure(file, result):
+    """
+    Manhattan plot of a harv_processed file.
+
+        Inputs:
+    file: harv_processed file from a given pathway.
+    result: SNIP calling result from called_snps.
+
+        Outputs:
+    figure with one subplot per chromosome of the file's genome profile (see profile_for), or all
+    chromosomes on one axis (see figure_layout): a plain dictionary from figure_dict, or a plotly
+    figure from plotly_figure when figure_builder is "plotly".
+    """
+    if figure_builder == "plotly":
+        return plotly_figure(file, result)
+    return figure_dict(file, result)
+
+
+def split_filter_part(filter_part):
+    """
+    Splits one condition of a DataTable filter_query ("{count} > 50") into
+    (column, operator word, value), e.g. ("count", "gt", 50.0), or (None, None, None)
+    when it is not understood.
+    """
+    for operator_type in filter_operators:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ""
+                if v0 == value_part[-1:] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                elif len(operator_type) == 1:  # text operators compare with the text as typed
+                    value = value_part
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                # word operators need spaces after them in the filter string,
+                # but we don't want these later
+                return name, operator_type[0].strip(), value
+
+    return None, None, None
+
+
+def filter_table(table, filter_query):
+    """Rows of the called SNPs table matching a DataTable filter_query (conditions joined by " && ")."""
+    for filter_part in filter_query.split(" && "):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in table.columns:
+            continue
+        column = table[col_name]
+        if operator in filter_comparisons:
+            try:
+                table = table[filter_comparisons[operator](column, filter_value)]
+            except TypeError:  # text compared with a numeric column
+                table = table.iloc[:0]
+        elif operator == "contains":
+            table = table[column.astype(str).str.contains(str(filter_value), regex=False)]
+        elif operator == "datestartswith":
+            table = table[column.astype(str).str.startswith(str(filter_value))]
+    return table
+
+
+def table_view(file, inputs, filter_query, sort_by):
+    """
+    Called SNPs table of a file for the app inputs, filtered by a DataTable filter_query and
+    sorted by its sort_by. Memoized in table_views, so changing pages does not redo it.
+    """
+    sort_by = tuple((column["column_id"], column["direction"]) for column in sort_by or [])
+    key = file_key(file) + inputs + (filter_query or "", sort_by)
+    table = table_views.get(key)
+    if table is None:
+        table = called_snps(file, inputs)["table"]
+        if filter_query:
+            table = filter_table(table, filter_query)
+        if sort_by:
+            table = table.sort_values([column for column, _ in sort_by],
+                                      ascending=[direction == "asc" for _, direction in sort_by],
+                                      kind="stable")
+        table_views.put(key, table)
+    return table
+
+
+def cache_stats():
+    """Hits, misses, number of entries and size of the app caches, to help sizing them (served on /_snip/cache)."""
+    return {"parsed_files": parsed_files.stats(),
+            "called_results": called_results.stats(),
+            "figures": figures.stats(),
+            "table_views": table_views.stats(),
+            "cumulative_axes": cumulative_axes.stats()}
+
+
+def _callback_output(request):
+    """Short name of the outputs of a Dash callback request ("man_plot.figure,called_table.columns")."""
+    body = request.get_json(silent=True) or {}
+    outputs = str(body.get("output", "")).strip(".").split("...")
+    return ",".join(output.split("@")[0] for output in outputs)
+
+
+def _before_request():
+    from flask import request
+
+    if request.path.endswith("/_dash-update-component"):
+        snip_metrics.request_started()
+
+
+def _after_request(response):
+    from flask import request
+
+    if request.path.endswith("/_dash-update-component"):
+        snip_metrics.request_finished(_callback_output(request), response.content_length or 0)
+    return response
+
 
+def metrics():
+    """
+    Metrics endpoint (/metrics) in the Prometheus text format: durations of the timed stages
+    (read, lod, index, call, table, figure, patch, detail, serialize, and catalog_read and catalog_lod
+    of the catalog indexing), duration and payload size
+    of the callback requests by output, and the cache counters of cache_stats.
+    """
+    from flask import Response, abort, request
 
+    if metrics_local_only and request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(403)
 
+    lines = []
+    for name, kind in (("hits", "counter"), ("misses", "counter"), ("entries", "gauge"), ("size", "gauge")):
+        metric = "snip_cache_%s%s" % (name, "_total" if kind == "counter" else "")
+        lines += ["# TYPE %s %s" % (metric, kind)]
+        lines += ['%s{cache="%s"} %d' % (metric, cache, stats[name]) for cache, stats in sorted(cache_stats().items())]
+    return Response(snip_metrics.render(lines), mimetype="text/plain; version=0.0.4")
 
+
+@pinned_files()
 def update_graph(filen,tavg,fact,peak_c,max_spac, min_vb):
 
     """
@@ -191,153 +778,497 @@ def update_graph(filen,tavg,fact,peak_c,max_spac, min_vb):
         Outputs
     container: Optional text to display the selected inputs.
     fig: interactie plotly figure for the Manhattan plot of the selected GWAS output.
-    data: table with example output data having the called SNPs and their attributes.
-    columns: columns for the table.
+    columns: columns for the table (its rows are served page by page by update_table).
     """
 
-    if type(filen) != list:
-        df_trim,noise_borders = read_harv_processed(pathway +filen)
-    else:
-        df_trim,noise_borders = read_harv_processed(pathway + filen[-1])
+    file = selected_file(filen)
+    inputs = normalize_inputs(tavg, fact, peak_c, max_spac, min_vb)
+    result = called_snps(file, inputs)
 
-    df_trim["LOD"] = np.log10(df_trim["p_wald"]) * (-1)
+    key = (file_key(file) + inputs +
+           (figure_layout, figure_builder, render_mode, webgl_min_points, thin_background, thin_lod_floor, thin_bins))
+    fig = figures.get(key)
+    if fig is None:
+        with timed("figure"):
+            fig = manhattan_figure(file, result)
+        figures.put(key, fig)
 
-    bonferroni = np.log10( 0.05 / 10709466) * (-1)
+    container = ""
 
-    dff = df_trim.copy()  # store a copy to enable resetting manipulation of parameters
+    return  container, fig, result["columns"]
 
-    fact = handle_inputs(fact,float)
 
-    noise_border = np.log10(float(noise_borders[tavg])) * (-1) *fact
+@pinned_files()
+def update_thresholds(tavg,fact,peak_c,max_spac, min_vb, filen):
 
-    peak_c = handle_inputs(peak_c,int)
-    max_spac = handle_inputs(max_spac,int)
-    min_vb = handle_inputs(min_vb,float)
+    """
+    Callback function which updates the called SNPs when a threshold input changes.
 
+        Inputs
+    tavg, fact, peak_c, max_spac, min_vb, filen: as in update_graph.
 
-    fig = make_subplots(rows = 1,
-                        cols = 5,
-                        shared_yaxes = True,
-                        horizontal_spacing = 0.01,
-                        subplot_titles=chromosomes_list)
+        Outputs
+    fig: partial update (Patch) of the Manhattan plot, replacing the "called" traces and,
+    when tavg or fact changed, the height of the noise line (see threshold_shapes).
+    The other traces are left untouched.
+    """
 
-    table_list = []
+    from dash import Patch, ctx
 
-    for chromosome in range(1,len(chromosomes_list) +1):
-        df_chr = df_trim[df_trim["chr"] == chromosome]
+    file = selected_file(filen)
+    result = called_snps(file, normalize_inputs(tavg, fact, peak_c, max_spac, min_vb))
+    noise_changed = ctx.triggered_id in ("Top avg", "factor")
 
-        fig.add_trace(go.Scatter(x = df_chr["ps"],
-                                 y = df_chr["LOD"],
-                                 hovertemplate=
-                                 "<br>pos: %{x}<br>" +
-                                 "<br>LOD: %{y}<br>"
-                                 ,
-                                 name='not called',
-                                 mode='markers',
-                                 marker=dict(
-                                     color='gray',
-                                     size=5,
-                                     )
-                                 ),
-                            row = 1,
-                            col = chromosome
-                        )
+    fig = Patch()
 
-        dff = df_chr[df_chr["GQS"] != "None"]
-        dff["GQS"] = dff["GQS"].astype(float)
-        dff = dff[dff["GQS"] > 3]
+    with timed("patch"):
+        if figure_layout == "cumulative":
+            dff = cumulative_snps(file, result["called"])
 
-        fig.add_trace(go.Scatter(x=dff["ps"],
-                                 y=dff["LOD"],
-                                 customdata = dff[["GQS", "spacing","count","monot","vbal1"]].values.tolist(),
-                                 hovertemplate =
-                                 "<br>pos: %{x}<br>" +
-                                 "<br>LOD: %{y}<br>" +
-                                 "<br>GQS: %{customdata[0]}<br>" +
-                                 "<br>spac: %{customdata[1]}<br>" +
-                                 "<br>count: %{customdata[2]}<br>" +
-                                 "<br>monot: %{customdata[3]}<br>" +
-                                 "<br>vbal1: %{customdata[4]}<br>",
-
-                                 # color_discrete_map = COLOUR_MAP,
-
-                                 mode='markers',
-                                 name='harvester called',
-                                 marker=dict(
-                                     color=dff["GQS"],
-                                     colorscale='Viridis_r',
-                                     cmin=2,
-                                     cmax=5,
-                                     colorbar=dict(x=- 0.11,
-                                                   title="GQS",
-                                                   tickvals=[2, 3, 4, 5],
-                                                   ticktext=["2", "3", "4", "5"]
-
-                                                   ),
-                                     size=5,
-                                 )
-                                 ),
-                      row=1,
-                      col=chromosome
-                      )
+            called = fig["data"][called_trace_index(1)]
+            called["x"] = typed_array(dff["x"])
+            called["y"] = typed_array(dff["LOD"])
+            called["customdata"] = peak_customdata(dff, cumulative=True)
+        else:
+            for column, chromosome in enumerate(profile_for(file).chromosomes, start=1):
+                dff = result["called"][chromosome]
 
-        dff["count"] = dff["count"].astype(float)
-        dff["spacing"] = dff["spacing"].astype(float)
-        dff["vbal1"] = dff["vbal1"].astype(float)
+                called = fig["data"][called_trace_index(column)]
+                called["x"] = typed_array(dff["ps"])
+                called["y"] = typed_array(dff["LOD"])
+                called["customdata"] = peak_customdata(dff)
 
-        dff = dff[(dff["LOD"] > noise_border) &
-                  (dff["LOD"] > bonferroni) &
-                  (dff["count"] > peak_c) &
-                  (dff["spacing"] < max_spac) &
-                  (dff["vbal1"] > min_vb)]
+        if noise_changed:
+            noise = fig["layout"]["shapes"][NOISE_SHAPE]
+            noise["y0"] = result["noise_border"]
+            noise["y1"] = result["noise_border"]
 
+    return fig
 
-        table_list.append(dff)
-        fig.add_trace(go.Scatter(x= dff["ps"],
-                                 y=dff["LOD"],
 
-                                 customdata=dff[["GQS", "spacing","count","monot","vbal1"]].values.tolist(),
-                                 hovertemplate=
-                                 "<br>pos: %{x}<br>" +
-                                 "<br>LOD: %{y}<br>" +
-                                 "<br>GQS: %{customdata[0]}<br>" +
-                                 "<br>spac: %{customdata[1]}<br>" +
-                                 "<br>count: %{customdata[2]}<br>" +
-                                 "<br>monot: %{customdata[3]}<br>" +
-                                 "<br>vbal1: %{customdata[4]}<br>",
-
-                                 mode='markers',
-                                 name='called',
-                                 marker=dict(
-                                     color='red',
-                                     size=5,)
-                                 ),
-                      row=1,
-                      col=chromosome
+@pinned_files()
+def update_table(filen,tavg,fact,peak_c,max_spac, min_vb, page_current, page_size, sort_by, filter_query):
+
+    """
+    Callback function which serves one page of the called SNPs table.
+
+        Inputs
+    filen, tavg, fact, peak_c, max_spac, min_vb: as in update_graph.
+    page_current, page_size, sort_by, filter_query: paging, sorting and filtering of the called_table.
+
+        Outputs
+    data: the called SNPs of the current page, after filtering and sorting.
+    page_count: number of pages.
+    page_current: the current page, moved back to the last page when the table got shorter.
+    """
+
+    with timed("table"):
+        table = table_view(selected_file(filen), normalize_inputs(tavg, fact, peak_c, max_spac, min_vb),
+                           filter_query, sort_by)
+
+        page_size = page_size or table_page_size
+        page_count = max(1, -(-len(table) // page_size))
+        page_current = min(page_current or 0, page_count - 1)
+
+        data = display_values(table.iloc[page_current * page_size:(page_current + 1) * page_size]).to_dict(orient='records')
+    return data, page_count, page_current
+
+
+def update_downloads(filen,tavg,fact,peak_c,max_spac, min_vb):
+
+    """
+    Callback function which points the download links to the called SNPs of the current inputs.
+
+        Inputs
+    filen, tavg, fact, peak_c, max_spac, min_vb: as in update_graph.
+
+        Outputs
+    href of the download links of export_formats (see download_called).
+    """
+
+    query = urlencode({"file": filen[-1] if type(filen) == list else filen,
+                       "tavg": "" if tavg is None else tavg,
+                       "factor": "" if fact is None else fact,
+                       "peak_count": "" if peak_c is None else peak_c,
+                       "max_spacing": "" if max_spac is None else max_spac,
+                       "min_vbal": "" if min_vb is None else min_vb})
+    return ["/_snip/download/%s?%s" % (fmt, query) for fmt in export_formats]
+
+
+def file_option(entry):
+    """Option of the filename dropdown for a catalog entry: its name, followed by its summary once it is indexed."""
+    label = entry["name"]
+    if entry["snps"] is not None:
+        label += " (%s SNPs" % format(entry["snps"], ",")
+        if entry["max_lod"] is not None:
+            label += ", %s in peaks, max LOD %.1f" % (format(entry["harvester_snps"], ","), entry["max_lod"])
+        label += ")"
+    return {'label': label, 'value': entry["name"]}
+
+
+def catalog_files():
+    """Catalog entries of all harv_processed files with their summaries, as JSON (served on /_snip/catalog)."""
+    return {"directory": catalog.directory, "files": catalog.files()}
+
+
+def update_file_options(search_value, filen):
+
+    """
+    Callback function which fills the filename dropdown with the files of the catalog matching the typed text.
+
+        Inputs
+    search_value: text typed in the filename dropdown.
+    filen: selected file, which stays among the options.
+
+        Outputs
+    options of the filename dropdown: at most dropdown_matches files, see Catalog.search and file_option.
+    """
+
+    options = [file_option(entry) for entry in catalog.search(search_value or "", dropdown_matches)]
+    selected = filen[-1] if type(filen) == list else filen
+    if selected and selected not in [option['value'] for option in options]:
+        options.append({'label': selected, 'value': selected})
+    return options
+
+
+def download_called(fmt):
+
+    """
+    Download endpoint (/_snip/download/<fmt>) streaming the called SNPs of a file for the
+    inputs given in the query string (see update_downloads) as CSV, Parquet or BED. Formats missing from
+    export_formats (Parquet without pyarrow) are not found (404), before any of the response is sent.
+    The file is generated in chunks from the memoized calling result by export_chunks.
+    Inputs which are not finite numbers, or a tavg outside of top_avg_values, are a bad request (400).
+    """
+
+    from flask import Response, abort, request
+
+    filen = request.args.get("file", "")
+    if fmt not in export_formats or filen != os.path.basename(filen) or filen not in catalog:
+        abort(404)
+
+    try:
+        # numbers as typed in the app, e.g. a peak count of 50.5 is 50 as in update_graph
+        inputs = normalize_inputs(int(request.args.get("tavg", 0)),
+                                  *[float(request.args[name]) if request.args.get(name) else None
+                                    for name in ("factor", "peak_count", "max_spacing", "min_vbal")])
+    except (ValueError, OverflowError):  # not a number, or a peak count or spacing of nan or inf
+        abort(400)
+    if inputs[0] not in top_avg_values or not np.all(np.isfinite(inputs[1:])):
+        abort(400)
+    table = called_snps(selected_file(filen), inputs)["table"]
+
+    name = "%s.called.%s" % (filen, fmt)
+    return Response(export_chunks(table, fmt),
+                    mimetype=export_formats[fmt],
+                    headers={"Content-Disposition": 'attachment; filename="%s"' % name})
+
+
+@pinned_files()
+def update_detail(relayout, filen):
+
+    """
+    Callback function which restores the full resolution of the thinned "not called" traces
+    (see background_snps) in the zoomed-in chromosome windows (of the single x-axis in the
+    cumulative layout, see cumulative_window).
+
+        Inputs
+    relayout: relayoutData of the Manhattan plot, describing the zoom.
+    filen: as in update_graph.
+
+        Outputs
+    fig: partial update (Patch) of the Manhattan plot, replacing the "not called" traces of
+    the zoomed chromosomes with all SNPs in the window (thinned again if there are more than
+    detail_max_points) and the thinned SNPs outside of it (see splice_window), and of the
+    reset chromosomes with the thinned trace.
+    """
+
+    from dash import Patch
+    from dash.exceptions import PreventUpdate
+
+    file = selected_file(filen)
+    chromosomes = profile_for(file).chromosomes
+    windows = zoomed_windows(relayout or {}, 1 if figure_layout == "cumulative" else len(chromosomes))
+    if not thin_background or not windows:
+        raise PreventUpdate
+
+    background = background_snps(file)
+
+    fig = Patch()
+    if figure_layout == "cumulative":
+        with timed("detail"):
+            df_back = cumulative_window(file, windows[1])
+
+        trace = fig["data"][background_trace_index(1)]
+        trace["x"] = typed_array(df_back["x"])
+        trace["y"] = typed_array(df_back["LOD"])
+        trace["customdata"] = typed_array(df_back["ps"])
+        trace["marker"]["color"] = typed_array(df_back["shade"])
+        return fig
+
+    for column, window in windows.items():
+        chromosome = chromosomes[column - 1]
+        with timed("detail"):
+            if window is None:
+                df_back = background[chromosome]
+            else:
+                df_window = chromosome_window(file, chromosome, *window)[["ps", "LOD"]]
+                if len(df_window) > detail_max_points:
+                    df_window = thin_snps(df_window, thin_lod_floor, thin_bins)
+                df_back = splice_window(background[chromosome], df_window, *window)
+
+        trace = fig["data"][background_trace_index(column)]
+        trace["x"] = typed_array(df_back["ps"])
+        trace["y"] = typed_array(df_back["LOD"])
+
+    return fig
+
+
+def make_layout(files):
+    """App layout written with Dash, renders in HTML. files: catalog entries of the files offered in the filename dropdown."""
+    from dash import dcc, html, dash_table
+
+    return html.Div([
+
+        html.H1("Semi-Natural Intelligence Peak calling (SNIP calling)", style = {'text-align':'center', "font-family":"Arial"}),
+        html.H2("Interactive dashboard for visualising GWAS output", style = {'text-align':'center', "font-family":"Arial"}),
+
+
+            html.Br(),
+            html.Div(className="row", children = [
+
+            html.Div([html.Label("Select file")], style = {"width":'48%', "font-family":"Arial", 'margin-left': "14%"}) ,
+               html.Div([html.Label("Peaks")], style = {"width":'25%', "font-family":"Arial", 'margin-left': "-22.5%"}) ,
+               html.Div([html.Label("Factor")],style = {"width":'6%', "font-family":"Arial", 'margin-left': "-16.15%"})  ,
+               html.Div([html.Label("Min SNPs")], style = {"width":'6%', "font-family":"Arial", 'margin-left': "3.6%"}) ,
+               html.Div([html.Label("Max spacing")], style = {"width":'6%', "font-family":"Arial", 'margin-left': "3.5%"}),
+               html.Div([html.Label("Min vbal")], style = {"width":'6%', "font-family":"Arial", 'margin-left': "3.4%"})
+            ], style = {"display" : "flex", "margin-top" : "1%" }),
+
+            html.Div( className="row",children = [
+
+            # html.Button('Next', id='next_button'),                          ###### to add
+
+            html.Div(dcc.Dropdown(id='filename',
+                         options=[
+                             file_option(entry) for entry in files
+                         ],
+                         multi=False,
+                         style = {"width":"80%", "margin-left":"0%"},
+                         value = files[0]["name"] if files else None
+
+                         ), style = {"width":"35%", "margin-left":"14%"}),
+
+            html.Div(dcc.Dropdown(id="Top avg",
+                         options=[
+                                  {"label":"5","value":0},
+                                  {"label":"6","value":1},
+                                  {"label":"7","value":2},
+                                  {"label":"8","value":3},
+                                  {"label":"9","value":4},
+                                  {"label":"10","value":5}
+                                  ],
+
+                         multi = False,
+                         value= 0,
+                         ), style = {"width":"6%", "margin-left":"-9.7%", "margin-right":"-0%"}),
+
+            dcc.Input(id="factor",
+                      type = "number",
+                      style = {"width":"6%",'margin-left': "3%"},
+                      value= 1.33
+                         ),
+
+            dcc.Input(id="peak_count",
+                      type = "number",
+                      style={"width":"6%",'margin-left': "3%"},
+                      # size = "2",
+                      value = 50,
+                      ),
+
+            dcc.Input(id="max_spacing",
+                      type = "number",
+                      style={"width":"6%",'margin-left': "3%"},
+                      value = 20000,
+                      ),
+            dcc.Input(id="min_vbal",
+                      type = "number",
+                      style={"width":"6%",'margin-left': "3%"},
+                      value = 0.1,
                       )
+            ], style = dict(display = "flex",margin_bottom = "-10%")),
+
 
-        fig.add_trace(go.Scatter(x=df_chr["ps"], y = [noise_border for _ in range(len(df_chr))],
-                                 name='noise',
-                                 mode= "lines",
-                                 line=dict(color='royalblue', width=2, dash='dash')),
-                        row=1,
-                        col=chromosome)
+        dcc.Graph(id='man_plot', figure = {}, style={'width': '100%', 'height': '75vh', "margin_top":"-70%"}),
 
-        fig.add_trace(go.Scatter(x=df_chr["ps"], y=[bonferroni for _ in range(len(df_chr))],
-                                 mode = "lines",
-                                 name='bonferroni',
-                                 line=dict(color='red', width=2, dash='dash')),
-                      row=1,
-                      col=chromosome)
+        html.Br(),
+        html.H3("Parameters of called SNPs",
+                style = {'text-align':'center', "font-family":"Arial"}),
+
+        html.Div([html.A("Download " + label, id="download_" + fmt, href="", download="",
+                         style={"margin-right": "2%"})
+                  for fmt, label in (("csv", "CSV"), ("parquet", "Parquet"), ("bed", "BED")) if fmt in export_formats],
+                 style={"text-align":'center', "font-family":"Arial", "margin-bottom": "1%"}),
+
+        dash_table.DataTable(id="called_table",
+                             page_action="custom",
+                             page_current=0,
+                             page_size=table_page_size,
+                             sort_action="custom",
+                             sort_mode="multi",
+                             sort_by=[],
+                             filter_action="custom",
+                             filter_query="",
+                             style_cell={
+                                 'overflow': 'hidden',
+                                 'textOverflow': 'ellipsis',
+                                 'maxWidth': 0,
+                                  "font-family":"Arial",
+                                  'text-align':'center'
+                             },
+                             style_table={"width":"95%",
+                                          "margin-left":"2.5%"}
+                             ),
+        html.Div(id= "output_container", children =[]),
+    ])
 
 
-    fig.update_layout(showlegend=False, yaxis_title="-log10(p-value)",)
-    container = ""
-    data = pandas.concat(table_list)
-    columns = [{'name': col, 'id': col} for col in data.columns]
-    data = data.to_dict(orient='records')
 
-    return  container, fig,data,columns
+def create_app(watch_catalog=True):
+    """
+    Creates the Dash app with the harv_processed files of pathway (see catalog), and registers its callbacks.
+    The catalog is brought up to date first and, with watch_catalog, kept up to date by a background
+    thread (see Catalog.start); snip_serve keeps it up to date from a separate process instead.
+
+    The callbacks connect the graph/table with input Dash components: update_graph builds the
+    whole figure when another file is selected, update_thresholds only resends the "called"
+    traces (and when needed the noise line) when a threshold changes, update_table serves the
+    current page of the called SNPs table, update_downloads points the download links to
+    the current inputs, update_file_options searches the files of the dropdown and update_detail restores
+    the full resolution of zoomed-in windows.
+    """
+    from dash import Dash, Input, Output, State
+
+    app = Dash(__name__)
+    typed_arrays_supported()  # warn at startup when the figures cannot use typed arrays
+    # the files are listed from the catalog whenever the page is loaded, new files appear without a restart;
+    # only the first dropdown_matches are sent, update_file_options serves the others while typing
+    catalog.refresh()
+    if watch_catalog:
+        catalog.start()
+    app.layout = lambda: make_layout(catalog.search("", dropdown_matches))
+
+    app.callback(
+        [Output(component_id='output_container', component_property='children'),
+         Output(component_id='man_plot', component_property='figure'),
+         Output(component_id="called_table", component_property = "columns")
+         ],
+        [Input(component_id="filename",component_property="value")],
+        [State(component_id='Top avg', component_property='value'),
+        State(component_id='factor',component_property='value'),
+        State(component_id='peak_count',component_property='value'),
+        State(component_id='max_spacing',component_property='value'),
+        State(component_id='min_vbal',component_property='value')
+        ]
+    )(update_graph)
+
+    app.callback(
+        Output(component_id='man_plot', component_property='figure', allow_duplicate=True),
+        [Input(component_id='Top avg', component_property='value'),
+        Input(component_id='factor',component_property='value'),
+        Input(component_id='peak_count',component_property='value'),
+        Input(component_id='max_spacing',component_property='value'),
+        Input(component_id='min_vbal',component_property='value')
+        ],
+        [State(component_id="filename",component_property="value")],
+        prevent_initial_call=True
+    )(update_thresholds)
+
+    app.callback(
+        [Output(component_id="called_table", component_property="data"),
+         Output(component_id="called_table", component_property="page_count"),
+         Output(component_id="called_table", component_property="page_current")
+         ],
+        [Input(component_id="filename",component_property="value"),
+        Input(component_id='Top avg', component_property='value'),
+        Input(component_id='factor',component_property='value'),
+        Input(component_id='peak_count',component_property='value'),
+        Input(component_id='max_spacing',component_property='value'),
+        Input(component_id='min_vbal',component_property='value'),
+        Input(component_id="called_table", component_property="page_current"),
+        Input(component_id="called_table", component_property="page_size"),
+        Input(component_id="called_table", component_property="sort_by"),
+        Input(component_id="called_table", component_property="filter_query")
+        ]
+    )(update_table)
+
+    app.callback(
+        [Output(component_id="download_" + fmt, component_property="href") for fmt in export_formats],
+        [Input(component_id="filename",component_property="value"),
+        Input(component_id='Top avg', component_property='value'),
+        Input(component_id='factor',component_property='value'),
+        Input(component_id='peak_count',component_property='value'),
+        Input(component_id='max_spacing',component_property='value'),
+        Input(component_id='min_vbal',component_property='value')
+        ]
+    )(update_downloads)
+
+    app.callback(
+        Output(component_id="filename", component_property="options"),
+        [Input(component_id="filename", component_property="search_value")],
+        [State(component_id="filename", component_property="value")],
+        prevent_initial_call=True
+    )(update_file_options)
+
+    app.callback(
+        Output(component_id='man_plot', component_property='figure', allow_duplicate=True),
+        [Input(component_id='man_plot', component_property='relayoutData')],
+        [State(component_id="filename",component_property="value")],
+        prevent_initial_call=True
+    )(update_detail)
+
+    # hit/miss counters of the caches, as JSON
+    app.server.route("/_snip/cache")(cache_stats)
+    # catalog of the harv_processed files with their summaries, as JSON
+    app.server.route("/_snip/catalog")(catalog_files)
+    # called SNPs of the current inputs as CSV, Parquet or BED
+    app.server.route("/_snip/download/<fmt>")(download_called)
+    # per-stage timings and payload sizes in the Prometheus text format
+    app.server.before_request(_before_request)
+    app.server.after_request(_after_request)
+    app.server.route("/metrics")(metrics)
+
+    return app
+
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    parser = argparse.ArgumentParser(description="SNIP calling dashboard")
+    parser.add_argument("--convert", action="store_true",
+                        help="write column stores for the harv_processed files in pathway and exit")
+    parser.add_argument("--render-mode", choices=("auto", "svg", "webgl"), default=render_mode,
+                        help="draw the Manhattan plot with SVG, WebGL or pick per trace by its size (default: %(default)s)")
+    parser.add_argument("--layout", choices=("subplots", "cumulative"), default=figure_layout,
+                        help="one subplot per chromosome, or all chromosomes on one x-axis (default: %(default)s)")
+    parser.add_argument("--profiles", default=profiles_path,
+                        help="JSON file with the genome profiles, see snip_calling.load_profiles (default: %(default)s)")
+    parser.add_argument("--figure-builder", choices=("dict", "plotly"), default=figure_builder,
+                        help="assemble the figures as plain dictionaries, or with the validating plotly graph objects (default: %(default)s)")
+    parser.add_argument("--catalog", default=catalog.path,
+                        help="SQLite catalog of the harv_processed files, on a local filesystem (default: %(default)s)")
+    parser.add_argument("--cache-budget", type=float, default=cache_memory_budget / 1024 ** 3,
+                        help="memory (GiB) for parsed harv_processed files kept between callbacks (default: %(default)s)")
+    args = parser.parse_args()
+    parsed_files.max_size = int(args.cache_budget * 1024 ** 3)
+    catalog = Catalog(pathway, args.catalog)
+    render_mode = args.render_mode
+    figure_layout = args.layout
+    figure_builder = args.figure_builder
+    load_profiles(args.profiles)
+
+    if args.convert:
+        for f in convert_harv_processed(pathway):
+            print("converted", f)
+    else:
+        # the reloader of the debug server runs this block in a watcher process and again in the
+        # serving process (with WERKZEUG_RUN_MAIN set), only the latter keeps the catalog up to date
+        create_app(watch_catalog=os.environ.get("WERKZEUG_RUN_MAIN") == "true").run(debug=True)
@@ -0,0 +1,102 @@
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pandas
+
+import snip_calling
+
+
+"""
+
+Headless batch SNIP calling: applies the peak calling of the dashboard (snip_calling: noise border x factor,
+Bonferroni of the file's genome profile, count, spacing and vbal1 filters) to every harv_processed file of a directory, in parallel across cores.
+
+For each file the called SNPs are written to <out>/<file>.called.tsv, and one line per file is added to
+<out>/summary.tsv. The Dash server is not started and no figures are built.
+
+    python snip_batch.py --out called/ --peaks 5 --factor 1.33 --min-snps 50 --max-spacing 20000 --min-vbal 0.1
+
+"""
+
+
+def call_file(file, inputs):
+    """
+    SNIP calling of one harv_processed file, without the app caches.
+
+        Inputs:
+    file: harv_processed file.
+    inputs: (tavg, fact, peak_c, max_spac, min_vb) as from snip_calling.normalize_inputs.
+
+        Outputs:
+    noise_border, number of SNPs in the file and the data frame of called SNPs of all chromosomes.
+    """
+    df, averages = snip_calling.parse_harv_processed(file)
+    tavg, fact, peak_c, max_spac, min_vb = inputs
+    noise_border = snip_calling.noise_threshold(averages, tavg, fact)
+    bonferroni_border = snip_calling.profile_for(file).bonferroni
+
+    offsets = snip_calling.position_index(df)
+    table_list = []
+    for chromosome in sorted(offsets):
+        start, stop = offsets[chromosome]
+        peaks = snip_calling.sort_by_lod(snip_calling.harvester_called(df.iloc[start:stop]))
+        table_list.append(snip_calling.call_snps(peaks, noise_border, peak_c, max_spac, min_vb, bonferroni_border))
+
+    return noise_border, len(df), pandas.concat(table_list) if table_list else df.iloc[:0]
+
+
+def process_file(name, directory, out, inputs):
+    """Calls the SNPs of directory/name, writes them to out and returns the summary line of the file."""
+    try:
+        noise_border, n_snps, called = call_file(os.path.join(directory, name), inputs)
+    except Exception as error:  # one broken file must not stop the whole run
+        return {"file": name, "error": "%s: %s" % (type(error).__name__, error)}
+
+    called.to_csv(os.path.join(out, name + ".called.tsv"), sep="\t", index=False)
+    return {"file": name,
+            "snps": n_snps,
+            "called": len(called),
+            "noise_border": noise_border,
+            "max_LOD": called["LOD"].max() if len(called) else None,
+            "error": None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch SNIP calling of all harv_processed files in a directory")
+    parser.add_argument("--pathway", default=snip_calling.pathway, help="directory with harv_processed files (default: %(default)s)")
+    parser.add_argument("--out", required=True, help="output directory for the called SNPs and summary.tsv")
+    parser.add_argument("--peaks", type=int, choices=range(5, 11), default=5,
+                        help="number of top peaks averaged in the noise threshold (default: %(default)s)")
+    parser.add_argument("--factor", type=float, default=1.33, help="noise threshold factor (default: %(default)s)")
+    parser.add_argument("--min-snps", type=int, default=50, help="minimal number of SNPs in a called peak (default: %(default)s)")
+    parser.add_argument("--max-spacing", type=int, default=20000, help="maximal spacing in a called peak (default: %(default)s)")
+    parser.add_argument("--min-vbal", type=float, default=0.1, help="minimal vbal of a called peak (default: %(default)s)")
+    parser.add_argument("--profiles", default=snip_calling.profiles_path,
+                        help="JSON file with the genome profiles, see snip_calling.load_profiles (default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    # the "Top avg" dropdown values are offsets from 5 peaks
+    inputs = snip_calling.normalize_inputs(args.peaks - 5, args.factor, args.min_snps, args.max_spacing, args.min_vbal)
+    names = sorted(snip_calling.list_harv_processed(args.pathway))
+    os.makedirs(args.out, exist_ok=True)
+
+    snip_calling.load_profiles(args.profiles)
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=snip_calling.load_profiles, initargs=(args.profiles,)) as pool:
+        summary = list(pool.map(process_file, names,
+                                [args.pathway] * len(names),
+                                [args.out] * len(names),
+                                [inputs] * len(names),
+                                chunksize=max(1, len(names) // (4 * args.jobs))))
+
+    summary = pandas.DataFrame(summary, columns=["file", "snps", "called", "noise_border", "max_LOD", "error"])
+    summary.to_csv(os.path.join(args.out, "summary.tsv"), sep="\t", index=False)
+
+    failed = summary["error"].notna().sum()
+    print("called %d files, %d failed" % (len(summary) - failed, failed), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import multiprocessing
+import numpy as np
+import pandas
+
+import snip_calling
+
+
+"""
+
+Synthetic harv_processed files and a reproducible benchmark of the SNIP calling dashboard.
+
+    python snip_bench.py generate --snps 10M --out bench_data/
+    python snip_bench.py run --sizes 100k,1M,10M --json bench.json [--baseline old.json]
+    python snip_bench.py check [--sizes 100k]
+
+generate writes a realistic harv_processed file: the averages header line, then chr, ps, p_wald, GQS, spacing,
+count, monot and vbal1 for SNPs spread over the chromosomes, with association peaks called by the harvester
+and "None" outside of them. run times loading (text and column store), calling and figure construction of
+update_graph for each size in a fresh process, and reports throughput and peak memory. With --baseline,
+stages slower than the baseline by more than --tolerance are reported and the exit status is 1.
+check verifies that the figures assembled as plain dictionaries (dashboard.figure_dict) are the same as the
+ones built with plotly graph objects (dashboard.plotly_figure), in both figure layouts.
+
+"""
+
+
+# lengths (bp) of the simulated chromosomes (Arabidopsis thaliana, TAIR10)
+chromosome_lengths = (30427671, 19698289, 23459830, 18585056, 26975502)
+
+# simulated association peaks per chromosome, their width (bp) and the SNPs written at a time
+peaks_per_chromosome = 20
+peak_width = 200000
+write_chunk = 1000000
+
+
+def parse_size(size):
+    """Number of SNPs from a size like 100k, 10M or 50000000."""
+    size = size.strip().lower()
+    factor = {"k": 10 ** 3, "m": 10 ** 6}.get(size[-1:], 1)
+    return int(float(size.rstrip("km")) * factor)
+
+
+def generate_harv_processed(file, n_snps, seed=0):
+    """
+    Writes a synthetic harv_processed file of n_snps SNPs.
+
+        Inputs:
+    file: path of the written file.
+    n_snps: number of SNPs, spread over the chromosomes proportionally to chromosome_lengths.
+    seed: seed of the random generator, the same seed gives the same file.
+
+    Background SNPs have uniform p-values. SNPs within peak_width/2 of a peak center get a LOD
+    decaying with the distance to the center and the harvester parameters (GQS, spacing, count,
+    monot, vbal1) of their peak; the other SNPs get "None". The averages line holds the expected
+    mean p-value of the top 5..10 noise peaks of the background.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.array(chromosome_lengths)
+    counts = np.diff(np.round(np.cumsum(lengths) / lengths.sum() * n_snps).astype(np.int64), prepend=0)
+
+    peaks = []
+    for length in lengths:
+        peaks.append((rng.integers(peak_width, length - peak_width, peaks_per_chromosome),
+                      rng.gamma(2.0, 4.0, peaks_per_chromosome) + 4,
+                      pandas.DataFrame({"GQS": rng.uniform(2, 5, peaks_per_chromosome),
+                                        "spacing": rng.integers(100, 40000, peaks_per_chromosome),
+                                        "count": rng.integers(5, 400, peaks_per_chromosome),
+                                        "monot": rng.uniform(0, 1, peaks_per_chromosome),
+                                        "vbal1": rng.uniform(0, 1, peaks_per_chromosome)}).round(3)))
+    # expected mean of the k smallest of n uniform p-values: the noise peaks of the background
+    averages = ["%.6g" % ((k + 1) / (2 * (n_snps + 1))) for k in range(5, 11)]
+
+    with open(file, "w") as handle:
+        handle.write("\t".join(averages) + "\n")
+        handle.write("\t".join(snip_calling.harv_processed_schema) + "\n")
+
+        for chromosome, (length, count, (centers, top_lods, parameters)) in enumerate(zip(lengths, counts, peaks), start=1):
+            order = np.argsort(centers)
+            ps = np.sort(rng.choice(length, count, replace=False) + 1) if count < length else np.arange(1, count + 1)
+            for start in range(0, count, write_chunk):
+                chunk_ps = ps[start:start + write_chunk]
+                p_wald = rng.uniform(0, 1, len(chunk_ps))
+
+                # nearest peak center of every SNP
+                nearest = np.clip(np.searchsorted(centers[order], chunk_ps), 1, peaks_per_chromosome - 1)
+                candidates = np.stack([order[nearest - 1], order[nearest]])
+                distance = np.abs(chunk_ps - centers[candidates])
+                peak = candidates[np.argmin(distance, axis=0), np.arange(len(chunk_ps))]
+                distance = distance.min(axis=0)
+
+                in_peak = distance < peak_width // 2
+                lod = top_lods[peak] * np.maximum(1 - 2 * distance / peak_width, 0) * rng.uniform(0.3, 1, len(chunk_ps))
+                p_wald = np.where(in_peak, np.minimum(p_wald, 10 ** -lod), p_wald)
+
+                chunk = pandas.DataFrame({"chr": chromosome, "ps": chunk_ps, "p_wald": p_wald})
+                for column in parameters:
+                    chunk[column] = np.where(in_peak, parameters[column].to_numpy()[peak], np.nan)
+                chunk.to_csv(handle, sep="\t", header=False, index=False, na_rep="None", float_format="%.6g")
+    return file
+
+
+def _measure(stages, name, function, n_snps):
+    """Runs function, records its duration and throughput (SNPs/s) in stages[name], returns its result."""
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    stages[name] = {"seconds": elapsed, "snps_per_second": n_snps / elapsed if elapsed else None}
+    return result
+
+
+def benchmark_file(file):
+    """
+    Benchmark of one harv_processed file, run in its own process (see run) so that the peak
+    memory is that of this file only.
+
+        Outputs:
+    dictionary with the number of SNPs, the measured stages and the peak resident memory (MiB).
+    """
+    import dashboard
+    from plotly.io.json import to_json_plotly
+
+    n_snps = len(snip_calling.read_harv_processed(file)[0])
+    inputs = snip_calling.normalize_inputs(0, 1.33, 50, 20000, 0.1)
+    stages = {}
+
+    _measure(stages, "load_text", lambda: snip_calling.read_harv_processed(file), n_snps)
+    _measure(stages, "write_columns", lambda: snip_calling.write_column_store(file), n_snps)
+    _measure(stages, "open_columns", lambda: snip_calling.read_column_store(file), n_snps)
+
+    snip_calling.parsed_files.clear()
+    _measure(stages, "load", lambda: snip_calling.load_harv_processed(file), n_snps)
+    result = _measure(stages, "call", lambda: snip_calling.called_snps(file, inputs), n_snps)
+    other = snip_calling.normalize_inputs(0, 1.5, 100, 20000, 0.1)
+    _measure(stages, "call_thresholds", lambda: snip_calling.called_snps(file, other), n_snps)
+
+    _measure(stages, "figure_plotly", lambda: dashboard.plotly_figure(file, result), n_snps)
+    fig = _measure(stages, "figure", lambda: dashboard.figure_dict(file, result), n_snps)
+    payload = _measure(stages, "serialize", lambda: to_json_plotly(fig), n_snps)
+
+    return {"snps": n_snps,
+            "stages": stages,
+            "figure_bytes": len(payload),
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def figure_differences(expected, actual, path="figure", tolerance=1e-9):
+    """
+    Differences between two figures (JSON-like values), as a list of "path: expected != actual"
+    lines. Numbers are compared with a relative tolerance, dictionaries regardless of key order.
+    """
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        differences = []
+        for key in sorted(set(expected) | set(actual)):
+            differences += figure_differences(expected.get(key), actual.get(key), "%s.%s" % (path, key), tolerance)
+        return differences
+    if isinstance(expected, list) and isinstance(actual, list) and len(expected) == len(actual):
+        differences = []
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            differences += figure_differences(e, a, "%s[%d]" % (path, i), tolerance)
+        return differences
+    if (isinstance(expected, (int, float)) and isinstance(actual, (int, float))
+            and not isinstance(expected, bool) and not isinstance(actual, bool)):
+        if np.isclose(expected, actual, rtol=tolerance, atol=tolerance):
+            return []
+    elif expected == actual:
+        return []
+    return ["%s: %r != %r" % (path, expected, actual)]
+
+
+def check_figures(file):
+    """
+    Compares the figures of dashboard.figure_dict with those of dashboard.plotly_figure for a
+    harv_processed file, in both figure layouts. Returns the differences (see figure_differences).
+    """
+    import dashboard
+    from plotly.io.json import to_json_plotly
+
+    result = snip_calling.called_snps(file, snip_calling.normalize_inputs(0, 1.33, 50, 20000, 0.1))
+    differences = []
+    for layout in ("subplots", "cumulative"):
+        dashboard.figure_layout = layout
+        expected = json.loads(to_json_plotly(dashboard.plotly_figure(file, result)))
+        actual = json.loads(to_json_plotly(dashboard.figure_dict(file, result)))
+        differences += figure_differences(expected, actual, layout)
+    return differences
+
+
+def run(files):
+    """Benchmarks the files one by one, each in a fresh worker process."""
+    results = {}
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        for file in files:
+            results[os.path.basename(file)] = pool.apply(benchmark_file, (file,))
+    return results
+
+
+def report(results, baseline=None, tolerance=0.2):
+    """Prints the results as a table and returns the stages slower than baseline by more than tolerance."""
+    regressions = []
+    for name, result in results.items():
+        print("%s: %d SNPs, peak memory %.0f MiB, figure %.1f MB" %
+              (name, result["snps"], result["peak_rss_mib"], result["figure_bytes"] / 1e6))
+        for stage, measured in result["stages"].items():
+            line = "    %-16s %9.3f s %14.0f SNPs/s" % (stage, measured["seconds"], measured["snps_per_second"] or 0)
+            previous = (baseline or {}).get(name, {}).get("stages", {}).get(stage)
+            if previous:
+                change = measured["seconds"] / previous["seconds"] - 1
+                line += "   %+6.1f%%" % (100 * change)
+                if change > tolerance:
+                    regressions.append((name, stage, change))
+                    line += "  REGRESSION"
+            print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic harv_processed files and SNIP benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="write a synthetic harv_processed file")
+    generate.add_argument("--snps", default="1M", help="number of SNPs, e.g. 100k, 10M (default: %(default)s)")
+    generate.add_argument("--out", default="bench_data/", help="output directory (default: %(default)s)")
+    generate.add_argument("--seed", type=int, default=0, help="random seed (default: %(default)s)")
+
+    check = commands.add_parser("check", help="compare the figures assembled as dictionaries with plotly graph objects")
+    check.add_argument("--sizes", default="100k", help="comma separated numbers of SNPs (default: %(default)s)")
+    check.add_argument("--data", default="bench_data/", help="directory of the generated files (default: %(default)s)")
+
+    bench = commands.add_parser("run", help="benchmark load, calling and figure construction")
+    bench.add_argument("--sizes", default="100k,1M,10M", help="comma separated numbers of SNPs (default: %(default)s)")
+    bench.add_argument("--data", default="bench_data/", help="directory of the generated files (default: %(default)s)")
+    bench.add_argument("--json", help="write the results to this JSON file")
+    bench.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    bench.add_argument("--tolerance", type=float, default=0.2,
+                       help="relative slow-down reported as regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        os.makedirs(args.out, exist_ok=True)
+        n_snps = parse_size(args.snps)
+        print(generate_harv_processed(os.path.join(args.out, "synthetic_%d_harv_processed.txt" % n_snps), n_snps, args.seed))
+        return 0
+
+    os.makedirs(args.data, exist_ok=True)
+    files = []
+    for size in args.sizes.split(","):
+        n_snps = parse_size(size)
+        file = os.path.join(args.data, "synthetic_%d_harv_processed.txt" % n_snps)
+        if not os.path.exists(file):
+            generate_harv_processed(file, n_snps)
+        files.append(file)
+
+    if args.command == "check":
+        failed = False
+        for file in files:
+            differences = check_figures(file)
+            print("%s: %s" % (os.path.basename(file), "figures match" if not differences else "%d differences" % len(differences)))
+            for difference in differences[:20]:
+                print("    " + difference)
+            failed = failed or bool(differences)
+        return 1 if failed else 0
+
+    results = run(files)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(results, handle, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,834 @@
+import os
+import json
+import shutil
+import hashlib
+import fnmatch
+import tempfile
+import threading
+import importlib.util
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import pandas
+
+from snip_metrics import timed
+
+
+"""
+
+SNIP calling library: loading of harv_processed files (GEMMA results combined with the Manhattan Harvester
+peak parameters) and the peak calling behind the dashboard, without the Dash app.
+
+Only numpy and pandas are imported (pyarrow only when calling results are shared or exported as Parquet),
+so pipelines, worker processes and tests can use the calling without paying for the plotly and dash imports.
+
+"""
+
+
+
+# path to the directory with har_processed files
+pathway = "harv_processed/"
+
+# columns of harv_processed files used by the app and their types at load time ("None" is read as NaN).
+# p_wald stays in double precision since p-values of strong peaks underflow float32,
+# count is a float because it is missing outside of the harvester peaks. chr is as wide as ps, since
+# assemblies with scaffolds number them well past 255 (pandas would wrap them in a narrower type).
+harv_processed_schema = {
+    "chr": "uint32",
+    "ps": "uint32",
+    "p_wald": "float64",
+    "GQS": "float32",
+    "spacing": "float32",
+    "count": "float32",
+    "monot": "float32",
+    "vbal1": "float32",
+}
+
+# sub-directory of pathway holding the typed binary copies (column stores) of harv_processed files
+sidecar_dir = ".snip"
+# bumped whenever the content of the column stores (see write_column_store) changes, older ones are then ignored
+COLUMN_STORE_VERSION = "2"
+# write a column store when a file without one is loaded, so that later loads (by any process) memory-map it
+column_store_on_load = False
+
+# JSON file with the genome profiles (see load_profiles), read once at startup; the one shipped next to
+# this module holds the built-in Arabidopsis thaliana (TAIR10) profile
+profiles_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "genome_profiles.json")
+
+# export formats of called SNPs (see export_chunks): MIME types, and rows converted at a time;
+# Parquet is only offered when pyarrow is installed
+export_formats = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet", "bed": "text/plain"}
+if importlib.util.find_spec("pyarrow") is None:
+    del export_formats["parquet"]
+export_chunk_rows = 100000
+
+# memory budget (in bytes) for parsed harv_processed files kept in memory between callbacks, the initial
+# max_size of parsed_files (changed by the --cache-budget option of dashboard and snip_serve)
+cache_memory_budget = 2 * 1024 ** 3
+# number of SNIP calling results kept for returning to previous inputs
+result_cache_size = 64
+
+# directory where SNIP calling results are shared between processes (e.g. the workers of snip_serve) as Arrow
+# files (needs pyarrow), None keeps them in the memory of each process only; at most result_store_size results
+# are kept on disk
+result_store_dir = None
+result_store_size = 1024
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the total size of its values.
+
+        Inputs:
+    max_size: maximal total size of the cached values.
+    sizeof: function returning the size of a value, in the same units as max_size
+    (by default every value has size 1, i.e. max_size is a number of entries).
+
+    Values bigger than max_size are never stored. max_size can be changed at any time,
+    the least recently used values are then evicted down to the new size. Hits and misses
+    are counted to help sizing the cache.
+    """
+
+    def __init__(self, max_size, sizeof=lambda value: 1):
+        self._max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size):
+        with self._lock:
+            self._max_size = max_size
+            self._evict()
+
+    def _evict(self):
+        """Drops the least recently used values until the cache fits max_size (the lock must be held)."""
+        while self.size > self._max_size:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.size -= evicted_size
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            if size > self._max_size:
+                return
+            self._items[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """Hits, misses, number of entries and total size of the cached values."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._items), "size": self.size}
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class GenomeProfile:
+    """
+    Chromosomes and marker panel of a studied genome.
+
+        Inputs:
+    name: name of the profile.
+    chromosomes: (number in the chr column, name, length in bp or None) of the chromosomes, in drawing order.
+    markers: total number of tested markers, for the Bonferroni correction.
+    files: fnmatch patterns of the names of the harv_processed files analysed with this profile.
+    significance: significance level of the Bonferroni correction.
+
+    The Bonferroni threshold is computed once, when the profile is created.
+    """
+
+    def __init__(self, name, chromosomes, markers, files=(), significance=0.05):
+        self.name = name
+        self.chromosomes = [int(number) for number, _, _ in chromosomes]
+        self.names = {int(number): chromosome for number, chromosome, _ in chromosomes}
+        self.lengths = {int(number): int(length) for number, _, length in chromosomes if length}
+        self.markers = markers
+        self.files = tuple(files)
+        self.bonferroni = np.log10(significance / markers) * (-1)
+
+    def chromosome_name(self, chromosome):
+        """Name of a chromosome number, generated for chromosomes that are not in the profile."""
+        return self.names.get(chromosome, "Chromosome %d" % chromosome)
+
+    def matches(self, name):
+        """Whether the harv_processed file name is analysed with this profile."""
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.files)
+
+
+def _nbytes(value):
+    """Approximate memory footprint (in bytes) of cached data: data frames, arrays and containers of them."""
+    if isinstance(value, pandas.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pandas.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+def _parsed_size(entry):
+    """Approximate memory footprint (in bytes) of a parsed_files entry, including its derived data."""
+    return _nbytes(entry["df"]) + _nbytes(entry["derived"])
+
+
+# genome profiles by name (see load_profiles), and the name of the one used for files matching no profile;
+# read from profiles_path when first needed, unless load_profiles was called before
+genome_profiles = {}
+default_profile = None
+_profiles_lock = threading.Lock()
+
+# parsed harv_processed files, keyed by path and validated by (mtime, size)
+parsed_files = LRUCache(cache_memory_budget, sizeof=_parsed_size)
+
+# SNIP calling results, keyed by file, (mtime, size), the normalized app inputs and the genome profile
+called_results = LRUCache(result_cache_size)
+
+# parsed_files entries used by the current thread within pinned_files, by path
+_pinned = threading.local()
+
+
+def load_profiles(path=None):
+    """
+    Reads the genome profiles from a JSON file into genome_profiles and default_profile.
+
+        Inputs:
+    path: JSON file (profiles_path by default) of the form
+    {"default": name, "profiles": {name: {"chromosomes": [{"number": 1, "name": "Chromosome 1", "length": 30427671}, ...],
+                                          "markers": 10709466, "files": ["*_harv_processed*"]}}}
+    The length and files entries are optional. Raises FileNotFoundError when the file does not exist.
+
+        Outputs:
+    genome_profiles.
+    """
+    global default_profile
+
+    path = path or profiles_path
+    with open(path) as handle:
+        config = json.load(handle)
+
+    profiles = {}
+    for name, profile in config["profiles"].items():
+        profiles[name] = GenomeProfile(name,
+                                       [(c["number"], c.get("name", "Chromosome %d" % c["number"]), c.get("length"))
+                                        for c in profile["chromosomes"]],
+                                       profile["markers"],
+                                       profile.get("files", ()),
+                                       profile.get("significance", 0.05))
+    default = config.get("default", next(iter(profiles)))
+    if default not in profiles:
+        raise ValueError("default genome profile %r is not defined in %s" % (default, path))
+
+    with _profiles_lock:
+        genome_profiles.clear()
+        genome_profiles.update(profiles)
+        default_profile = default
+    return genome_profiles
+
+
+def profile_for(file):
+    """GenomeProfile of a harv_processed file: the first profile matching its name, otherwise default_profile."""
+    with _profiles_lock:
+        loaded = bool(genome_profiles)
+    if not loaded:
+        load_profiles()
+    name = os.path.basename(file)
+    for profile in genome_profiles.values():
+        if profile.matches(name):
+            return profile
+    return genome_profiles[default_profile]
+
+
+def read_harv_processed(file):
+    """
+        Inputs:
+    file: harv_processed file from a given pathway.
+
+        Outputs:
+    averages: the list generated from the first line of harv_processed
+    file (average LODs of top 5-10 peaks).
+
+    df (pandas data frame) containing the GEMMA (GWAS pipeline) and harvester
+    combined information about SNPs and parameters in their allocated peaks.
+    Only the columns of harv_processed_schema are read, with their declared types,
+    and the SNPs are sorted by chromosome and position (see position_index).
+    """
+    with open(file) as file:
+        line = file.readline().strip()
+        averages = line.split("\t")
+        df = pandas.read_csv(file,
+                             sep="\t",
+                             usecols=list(harv_processed_schema),
+                             dtype=harv_processed_schema,
+                             na_values=["None"])
+        return sort_by_position(df), averages
+
+
+def sort_by_position(df):
+    """Sorts a harv_processed data frame by chromosome and position, unless it already is."""
+    chrs = df["chr"].to_numpy()
+    ps = df["ps"].to_numpy()
+    if np.all((chrs[1:] > chrs[:-1]) | ((chrs[1:] == chrs[:-1]) & (ps[1:] >= ps[:-1]))):
+        return df
+    return df.iloc[np.lexsort((ps, chrs))].reset_index(drop=True)
+
+
+def position_index(df):
+    """
+    Offsets of the chromosomes in a harv_processed data frame sorted by sort_by_position.
+
+        Outputs:
+    dictionary chromosome: (start, stop), the rows of the chromosome are df.iloc[start:stop].
+    """
+    chrs = df["chr"].to_numpy()
+    if len(chrs) == 0:
+        return {}
+    starts = np.concatenate([[0], np.flatnonzero(chrs[1:] != chrs[:-1]) + 1])
+    stops = np.append(starts[1:], len(chrs))
+    return {int(chrs[start]): (int(start), int(stop)) for start, stop in zip(starts, stops)}
+
+
+def add_lod(df):
+    """Adds the LOD column (-log10 of the p_wald p-value, float32) to a harv_processed data frame."""
+    df["LOD"] = (np.log10(df["p_wald"]) * (-1)).astype("float32")
+    return df
+
+
+def decimal_values(values):
+    """
+    float32 values as float64, each with the shortest decimal representation of its float32 value,
+    i.e. the number as written in the harv_processed file (3.095, not 3.0950000286102295).
+
+    Vectorized: the values are rounded to 1, 2, ... 9 significant digits (9 always identify a float32)
+    and each one keeps the first rounding that converts back to the same float32.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    wide = values.astype(np.float64)
+    result = wide.copy()
+    pending = np.flatnonzero(np.isfinite(wide) & (wide != 0))
+    exponent = np.floor(np.log10(np.abs(wide[pending]))).astype(np.int64)
+    for digits in range(1, 10):
+        if len(pending) == 0:
+            break
+        # powers of ten are exact up to 10 ** 22, so both branches give the double closest to the decimal
+        power = digits - 1 - exponent
+        scale = 10.0 ** np.abs(power)
+        rounded = np.where(power >= 0,
+                           np.round(wide[pending] * scale) / scale,
+                           np.round(wide[pending] / scale) * scale)
+        found = rounded.astype(np.float32) == values[pending]
+        result[pending[found]] = rounded[found]
+        pending, exponent = pending[~found], exponent[~found]
+    return result
+
+
+def display_values(df):
+    """
+    Copy of (a part of) a harv_processed data frame for showing to the user: the float32 columns
+    are converted by decimal_values, and LOD is computed again from p_wald in double precision
+    when both are there. Storage and calling keep the compact types of harv_processed_schema.
+    """
+    shown = pandas.DataFrame({column: decimal_values(df[column]) if df[column].dtype == np.float32 else df[column]
+                              for column in df}, index=df.index)
+    if "LOD" in shown and "p_wald" in shown:
+        shown["LOD"] = np.log10(shown["p_wald"].to_numpy()) * (-1)
+    return shown
+
+
+def _feather():
+    """pyarrow.feather, or None when pyarrow is not installed (shared results are optional)."""
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        return None
+    return feather
+
+
+def column_store_path(file):
+    """Directory of the column store (see write_column_store) belonging to a harv_processed file."""
+    directory, name = os.path.split(os.path.abspath(file))
+    return os.path.join(directory, sidecar_dir, name + ".columns")
+
+
+def write_column_store(file):
+    """
+    One-time conversion of a harv_processed file into a column store: one raw array file
+    (<column>.bin) per column of harv_processed_schema and the LOD column, and meta.json
+    with the averages line, the number of SNPs and the column types.
+
+        Inputs:
+    file: harv_processed file from a given pathway.
+
+        Outputs:
+    path of the written column store directory.
+
+    Only numpy is needed to write and open it. Several processes may convert the same file at
+    once, each writes its own staging directory and the first one to finish is kept.
+    """
+    df, averages = read_harv_processed(file)
+    add_lod(df)
+
+    target = column_store_path(file)
+    staging = "%s.%d.%d.tmp" % (target, os.getpid(), threading.get_ident())
+    os.makedirs(staging)
+    for column in df:
+        df[column].to_numpy().tofile(os.path.join(staging, column + ".bin"))
+    with open(os.path.join(staging, "meta.json"), "w") as handle:
+        json.dump({"version": COLUMN_STORE_VERSION,
+                   "averages": averages,
+                   "rows": len(df),
+                   "columns": {column: df[column].dtype.str for column in df}}, handle)
+
+    if read_column_store(file) is None:  # outdated, and not written meanwhile by another process
+        shutil.rmtree(target, ignore_errors=True)
+    try:
+        os.replace(staging, target)
+    except OSError:  # written meanwhile by another process
+        shutil.rmtree(staging, ignore_errors=True)
+    return target
+
+
+def read_column_store(file):
+    """
+    Opens the column store of a harv_processed file written by write_column_store.
+
+    Returns (df, averages) as read_harv_processed, or None when there is no column store
+    or it is older than the file itself. The columns of df are read-only np.memmap arrays,
+    so opening a file costs no parsing or allocation, only page-ins of the parts that
+    are used, and processes opening the same store share its pages through the OS page cache.
+    """
+    target = column_store_path(file)
+    meta = os.path.join(target, "meta.json")
+    if not os.path.exists(meta) or os.path.getmtime(meta) < os.path.getmtime(file):
+        return None
+
+    with open(meta) as handle:
+        meta = json.load(handle)
+    if meta.get("version") != COLUMN_STORE_VERSION:
+        return None
+
+    columns = {}
+    for column, dtype in meta["columns"].items():
+        if meta["rows"] == 0:  # empty files cannot be memory-mapped
+            columns[column] = np.empty(0, dtype=dtype)
+        else:
+            columns[column] = np.memmap(os.path.join(target, column + ".bin"), dtype=dtype, mode="r",
+                                        shape=(meta["rows"],))
+    return pandas.DataFrame(columns, copy=False), meta["averages"]
+
+
+def convert_harv_processed(directory):
+    """
+    Writes column stores (see write_column_store) for all harv_processed files in directory
+    that have none or an outdated one. Returns the list of converted files.
+    """
+    converted = []
+    for f in list_harv_processed(directory):
+        file = os.path.join(directory, f)
+        if read_column_store(file) is None:
+            write_column_store(file)
+            converted.append(f)
+    return converted
+
+
+def list_harv_processed(directory):
+    """Names of all harv_processed files in the given directory."""
+    return [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))  and "harv_processed" in f]
+
+
+def load_harv_processed(file):
+    """
+    Cached version of read_harv_processed, which also adds the LOD column.
+
+        Inputs:
+    file: harv_processed file from a given pathway.
+
+        Outputs:
+    df, averages as in read_harv_processed, with the LOD column (see add_lod).
+
+    The parsed file is kept in memory (see cache_memory_budget) and reused as long as
+    the file's modification time and size do not change, so changing the thresholds
+    in the app never touches the file again. The returned data frame is shared
+    between callbacks and must not be modified in place.
+
+    When an up-to-date column store (see write_column_store) exists, it is opened instead of the text file.
+    """
+    entry = _load_entry(file)[1]
+    return entry["df"], entry["averages"]
+
+
+def parse_harv_processed(file):
+    """
+    Uncached loading of a harv_processed file: opens its column store when it is up to date,
+    otherwise reads the text file, and adds the LOD column. Returns df, averages.
+    With column_store_on_load, the text file is converted into a column store first (unless
+    its directory is not writable), which is then opened.
+    """
+    with timed("read"):
+        parsed = read_column_store(file)
+        if parsed is None and column_store_on_load:
+            try:
+                write_column_store(file)
+                parsed = read_column_store(file)
+            except OSError:  # e.g. a read-only directory
+                pass
+        if parsed is None:
+            parsed = read_harv_processed(file)
+    if "LOD" not in parsed[0]:
+        with timed("lod"):
+            add_lod(parsed[0])
+    return parsed
+
+
+@contextmanager
+def pinned_files():
+    """
+    Context manager (or decorator) keeping the harv_processed files loaded by the current thread
+    within its block in memory until the block ends, even when parsed_files cannot hold them
+    (a file and its derived data bigger than cache_memory_budget). Every file is then parsed
+    at most once per block, however often the block looks it up again. Blocks may be nested,
+    the files are released when the outermost block ends.
+    """
+    outer = getattr(_pinned, "entries", None)
+    if outer is None:
+        _pinned.entries = {}
+    try:
+        yield
+    finally:
+        if outer is None:
+            _pinned.entries = None
+
+
+def _load_entry(file):
+    """Path and parsed_files entry (stamp, df, averages, derived) of a harv_processed file."""
+    path, stamp = file_key(file)
+
+    pinned = getattr(_pinned, "entries", None)
+    entry = pinned.get(path) if pinned is not None else None
+    if entry is None or entry["stamp"] != stamp:
+        entry = parsed_files.get(path)
+    if entry is None or entry["stamp"] != stamp:
+        df, averages = parse_harv_processed(path)
+        entry = {"stamp": stamp, "df": df, "averages": averages, "derived": {}}
+        parsed_files.put(path, entry)
+
+    if pinned is not None:
+        pinned[path] = entry
+    return path, entry
+
+
+def file_key(file):
+    """
+    Absolute path and (mtime, size) of a harv_processed file, to key results derived from it. Only
+    stats the file, so memoized results are found without loading it (see parsed_files).
+    """
+    path = os.path.abspath(file)
+    stat = os.stat(path)
+    return path, (stat.st_mtime_ns, stat.st_size)
+
+
+def file_derived(file, name, build):
+    """
+    Data derived from a harv_processed file, computed once per loaded file.
+
+        Inputs:
+    file: harv_processed file from a given pathway.
+    name: hashable name of the derived data (including the parameters it depends on).
+    build: function computing the derived data from the data frame of load_harv_processed.
+
+        Outputs:
+    build(df), kept in parsed_files together with the parsed file. It counts towards
+    cache_memory_budget and is dropped with the file when it is evicted or changes.
+    """
+    path, entry = _load_entry(file)
+    if name not in entry["derived"]:
+        entry["derived"][name] = build(entry["df"])
+        parsed_files.put(path, entry)  # account for the size of the derived data
+    return entry["derived"][name]
+
+
+def file_chromosomes(file):
+    """
+    Chromosomes of a harv_processed file: those of its genome profile (see profile_for) in the
+    profile's order, followed by any other found in its chr column (e.g. scaffolds), sorted.
+    """
+    chromosomes = profile_for(file).chromosomes
+    found = file_derived(file, "position_index", position_index)
+    return chromosomes + sorted(set(found) - set(chromosomes))
+
+
+def chromosome_snps(file, chromosome):
+    """SNPs of a chromosome of a harv_processed file: a slice of the data frame located by its position_index."""
+    df_trim, _ = load_harv_processed(file)
+    start, stop = file_derived(file, "position_index", position_index).get(chromosome, (0, 0))
+    return df_trim.iloc[start:stop]
+
+
+def chromosome_window(file, chromosome, start, end):
+    """SNPs of a chromosome with position between start and end (both included), found by binary search."""
+    df_chr = chromosome_snps(file, chromosome)
+    ps = df_chr["ps"].to_numpy()
+    return df_chr.iloc[np.searchsorted(ps, start, side="left"):np.searchsorted(ps, end, side="right")]
+
+
+def handle_inputs(input, new_type = int, default_value = 0):
+    """
+    function which handles the app dcc.input values and returns them in desired type/format.
+    Handles dcc.input of type number. If input is not given, default value is returned.
+    """
+    if input is not None and len(str(input)) > 0:
+         return new_type(input)
+    else:
+        return default_value
+
+
+def normalize_inputs(tavg, fact, peak_c, max_spac, min_vb):
+    """
+    Converts the app threshold inputs (see dashboard.update_graph) into their numeric types,
+    missing inputs are replaced by handle_inputs defaults.
+    """
+    return (tavg,
+            handle_inputs(fact,float),
+            handle_inputs(peak_c,int),
+            handle_inputs(max_spac,int),
+            handle_inputs(min_vb,float))
+
+
+def noise_threshold(noise_borders, tavg, fact):
+    """Noise threshold in LOD units: -log10 of the tavg-th average of the averages line, times fact."""
+    return np.log10(float(noise_borders[tavg])) * (-1) *fact
+
+
+def harvester_called(df_chr):
+    """SNPs of a chromosome which are in a peak called by Manhattan Harvester (GQS over 3)."""
+    return df_chr[df_chr["GQS"] > 3]
+
+
+def peaks_by_lod(file):
+    """
+    Harvester called SNPs (see harvester_called) of each chromosome of a harv_processed file
+    (see file_chromosomes), sorted by descending LOD. Computed once per loaded file, see file_derived.
+
+        Outputs:
+    dictionary chromosome: (dff, neg_lod), where neg_lod are the negated LODs of dff
+    (ascending, for binary search in call_snps).
+    """
+    def build(df):
+        with timed("index"):
+            return {chromosome: sort_by_lod(harvester_called(chromosome_snps(file, chromosome)))
+                    for chromosome in file_chromosomes(file)}
+
+    return file_derived(file, "peaks_by_lod", build)
+
+
+def sort_by_lod(dff):
+    """(dff sorted by descending LOD, its negated LODs) as expected by call_snps."""
+    neg_lod = dff["LOD"].to_numpy() * (-1)
+    order = np.argsort(neg_lod, kind="stable")
+    return dff.iloc[order], neg_lod[order]
+
+
+def call_snps(peaks, noise_border, peak_c, max_spac, min_vb, bonferroni_border):
+    """
+    SNIP calling: filters the harvester called SNPs of a chromosome by the noise and
+    Bonferroni thresholds and the peak parameters.
+
+        Inputs:
+    peaks: (dff, neg_lod) of the chromosome from peaks_by_lod (or sort_by_lod).
+    noise_border, peak_c, max_spac, min_vb: thresholds, see thresholds.
+    bonferroni_border: Bonferroni threshold of the file's genome profile (see GenomeProfile).
+
+        Outputs:
+    called SNPs, sorted by descending LOD. The LOD thresholds select a prefix of dff by
+    binary search, the peak parameters are only checked within it.
+    """
+    dff, neg_lod = peaks
+    dff = dff.iloc[:np.searchsorted(neg_lod, max(noise_border, bonferroni_border) * (-1), side="left")]
+    return dff[(dff["count"] > peak_c) &
+               (dff["spacing"] < max_spac) &
+               (dff["vbal1"] > min_vb)]
+
+
+def table_output(table_list):
+    """Data frame and columns of the called_table from the per-chromosome called SNPs."""
+    table = pandas.concat(table_list, ignore_index=True)
+    columns = [{'name': col, 'id': col} for col in table.columns]
+    return table, columns
+
+
+@pinned_files()
+def called_snps(file, inputs):
+    """
+    SNIP calling of a harv_processed file for the app inputs, memoized in called_results.
+
+        Inputs:
+    file: harv_processed file from a given pathway.
+    inputs: (tavg, fact, peak_c, max_spac, min_vb) from normalize_inputs.
+
+        Outputs:
+    dictionary with the noise_border, the Bonferroni threshold of the file's genome profile
+    ("bonferroni"), the called SNPs of each chromosome ("called"),
+    and the called SNPs of all chromosomes ("table") with the "columns" of the called_table.
+    Results are also shared with other processes when result_store_dir is set.
+    """
+    profile = profile_for(file)
+    key = file_key(file) + inputs + (profile.name, profile.bonferroni)
+    result = called_results.get(key)
+    if result is None:
+        result = stored_result(key)
+        if result is None:
+            tavg, fact, peak_c, max_spac, min_vb = inputs
+            noise_border = noise_threshold(load_harv_processed(file)[1], tavg, fact)
+            peaks = peaks_by_lod(file)
+            bonferroni_border = profile.bonferroni
+
+            with timed("call"):
+                called = {chromosome: call_snps(peaks[chromosome], noise_border, peak_c, max_spac, min_vb,
+                                                bonferroni_border)
+                          for chromosome in peaks}
+                table, columns = table_output(list(called.values()))
+
+            result = {"noise_border": noise_border, "bonferroni": bonferroni_border, "called": called,
+                      "table": table, "columns": columns}
+            store_result(key, result)
+        called_results.put(key, result)
+    return result
+
+
+def _result_path(key):
+    """Path of a result in result_store_dir, named by the hash of its called_results key."""
+    return os.path.join(result_store_dir, hashlib.sha1(repr(key).encode()).hexdigest() + ".arrow")
+
+
+def stored_result(key):
+    """
+    Result of called_snps stored by any process in result_store_dir, or None. Results are plain
+    Arrow tables with JSON metadata, reading them never runs code from the shared directory.
+    """
+    feather = _feather()
+    if result_store_dir is None or feather is None:
+        return None
+    try:
+        table = feather.read_table(_result_path(key))
+    except (OSError, ValueError):  # missing, or being replaced by another process
+        return None
+    metadata = table.schema.metadata or {}
+    if metadata.get(b"snip.key") != repr(key).encode():
+        return None
+
+    stored = json.loads(metadata[b"snip.result"])
+    table = table.to_pandas()
+    chrs = table["chr"].to_numpy()
+    called = {chromosome: table[chrs == chromosome] for chromosome in stored["chromosomes"]}
+    return {"noise_border": stored["noise_border"], "bonferroni": stored["bonferroni"], "called": called,
+            "table": table, "columns": [{'name': col, 'id': col} for col in table.columns]}
+
+
+def store_result(key, result):
+    """
+    Shares a result of called_snps with the other processes through result_store_dir: its table of
+    called SNPs as an Arrow file, with the thresholds and the chromosomes in the schema metadata. Files
+    are written atomically, and the oldest ones are removed when there are more than result_store_size.
+    """
+    if result_store_dir is None or _feather() is None:
+        return
+    import pyarrow
+    import pyarrow.feather as feather
+
+    table = pyarrow.Table.from_pandas(result["table"], preserve_index=False)
+    table = table.replace_schema_metadata({b"snip.key": repr(key).encode(),
+                                           b"snip.result": json.dumps({"noise_border": float(result["noise_border"]),
+                                                                       "bonferroni": float(result["bonferroni"]),
+                                                                       "chromosomes": list(result["called"])}).encode()})
+    os.makedirs(result_store_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=result_store_dir, suffix=".tmp", delete=False) as handle:
+        feather.write_feather(table, handle, compression="uncompressed")
+    os.replace(handle.name, _result_path(key))
+
+    stored = [entry for entry in os.scandir(result_store_dir) if entry.name.endswith(".arrow")]
+    if len(stored) > result_store_size:
+        stored.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in stored[:len(stored) - result_store_size]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:  # removed by another process
+                pass
+
+
+def bed_records(table):
+    """
+    Called SNPs as BED5 records: chromosome ("chr" + number), 0-based start, end, name
+    ("chromosome:position") and score (LOD x 100, capped at the BED maximum of 1000).
+    """
+    chrom = "chr" + table["chr"].astype(str)
+    return pandas.DataFrame({"chrom": chrom,
+                             "start": table["ps"].astype(np.int64) - 1,
+                             "end": table["ps"],
+                             "name": chrom + ":" + table["ps"].astype(str),
+                             "score": np.clip(np.nan_to_num(table["LOD"].to_numpy() * 100), 0, 1000).astype(int)})
+
+
+def export_chunks(table, fmt, chunk_rows=export_chunk_rows):
+    """
+    Exports a called SNPs table chunk by chunk, so it is never converted as a whole.
+
+        Inputs:
+    table: called SNPs, e.g. the "table" of called_snps.
+    fmt: one of export_formats (csv, bed, and parquet when pyarrow is installed).
+    chunk_rows: rows converted at a time.
+
+        Outputs:
+    generator of bytes of the exported file. BED records are sorted by position. Parquet is
+    written in row groups of chunk_rows to a temporary file, which is then read back in blocks.
+    """
+    starts = range(0, max(len(table), 1), chunk_rows)
+    if fmt == "csv":
+        for start in starts:
+            yield table.iloc[start:start + chunk_rows].to_csv(index=False, header=start == 0).encode()
+    elif fmt == "bed":
+        table = table.sort_values(["chr", "ps"], kind="stable")  # BED tools expect sorted records
+        for start in starts:
+            yield bed_records(table.iloc[start:start + chunk_rows]).to_csv(sep="\t", index=False, header=False).encode()
+    elif fmt == "parquet" and fmt in export_formats:
+        import pyarrow
+        import pyarrow.parquet as parquet
+
+        schema = pyarrow.Schema.from_pandas(table, preserve_index=False)
+        with tempfile.TemporaryFile() as handle:
+            with parquet.ParquetWriter(handle, schema) as writer:
+                for start in starts:
+                    writer.write_table(pyarrow.Table.from_pandas(table.iloc[start:start + chunk_rows],
+                                                                 schema=schema, preserve_index=False))
+            handle.seek(0)
+            for block in iter(lambda: handle.read(1024 * 1024), b""):
+                yield block
+    else:
+        raise ValueError("unknown export format %r, expected one of %s" % (fmt, ", ".join(export_formats)))
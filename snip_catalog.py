@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import signal
+import sqlite3
+import threading
+import multiprocessing
+import numpy as np
+
+import snip_calling
+import snip_metrics
+
+
+"""
+
+Persistent catalog of the harv_processed files of a directory, kept in SQLite (by default in catalog_dir).
+
+For every file the catalog holds its size and modification time, and once indexed the number of SNPs, the averages
+line and summary statistics (SNPs called by the harvester, highest LOD). refresh compares the directory with the
+catalog by size and modification time only, so unchanged files are never read again; start keeps the catalog up
+to date in a background thread (or start_process in a separate process). Several processes (e.g. the workers of snip_serve) can share one catalog.
+
+The database uses SQLite's write-ahead log, which does not work on network filesystems: it must be on a local
+disk, even when the directory of harv_processed files is not. Failed refreshes are logged (logger).
+
+"""
+
+
+# seconds between two refreshes of the catalog by the background thread
+refresh_interval = 30
+
+# local directory of the catalog databases, one per directory of harv_processed files
+catalog_dir = os.path.join(os.path.expanduser("~"), ".cache", "snip")
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    snps INTEGER,
+    harvester_snps INTEGER,
+    max_lod REAL,
+    averages TEXT,
+    indexed_at REAL
+)
+"""
+
+
+def file_summary(file):
+    """
+    Summary of a harv_processed file stored in the catalog. Its loading is timed under the
+    catalog_ stages (see snip_metrics.stage_prefix), apart from those of the app requests.
+
+        Outputs:
+    dictionary with the number of SNPs, of SNPs called by the harvester (see snip_calling.harvester_called),
+    the highest LOD and the averages line (as JSON).
+    """
+    with snip_metrics.stage_prefix("catalog_"):
+        df, averages = snip_calling.parse_harv_processed(file)
+    lod = df["LOD"].to_numpy()
+    return {"snps": len(df),
+            "harvester_snps": len(snip_calling.harvester_called(df)),
+            "max_lod": float(np.nanmax(lod)) if len(lod) else None,
+            "averages": json.dumps(averages)}
+
+
+class Catalog:
+    """
+    Catalog of the harv_processed files of a directory.
+
+        Inputs:
+    directory: directory with harv_processed files (e.g. snip_calling.pathway).
+    path: SQLite database on a local filesystem, by default catalog_dir/catalog-<hash of the directory>.sqlite.
+    """
+
+    def __init__(self, directory, path=None):
+        self.directory = directory
+        self.path = path or os.path.join(catalog_dir, "catalog-%s.sqlite" %
+                                         hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16])
+        self._thread = None
+
+    def _connect(self):
+        """New connection to the catalog (one per call, so the catalog can be used from any thread)."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(SCHEMA)
+        return connection
+
+    def refresh(self):
+        """
+        Brings the list of files up to date: files that are new or whose size or modification time
+        changed are (re)added without summary, files that disappeared are removed. Only the directory
+        entries are read. Returns the numbers of added/changed and removed files.
+        """
+        found = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if "harv_processed" in entry.name and entry.is_file():
+                    stat = entry.stat()
+                    found[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+        connection = self._connect()
+        try:
+            with connection:
+                known = {name: (size, mtime_ns) for name, size, mtime_ns
+                         in connection.execute("SELECT name, size, mtime_ns FROM files")}
+                changed = [(name, size, mtime_ns) for name, (size, mtime_ns) in found.items()
+                           if known.get(name) != (size, mtime_ns)]
+                removed = [(name,) for name in known if name not in found]
+                connection.executemany("INSERT OR REPLACE INTO files (name, size, mtime_ns) VALUES (?, ?, ?)", changed)
+                connection.executemany("DELETE FROM files WHERE name = ?", removed)
+        finally:
+            connection.close()
+        return len(changed), len(removed)
+
+    def index(self):
+        """Computes the summaries (see file_summary) of the files that have none yet. Returns the number of indexed files."""
+        connection = self._connect()
+        try:
+            pending = connection.execute("SELECT name, size, mtime_ns FROM files WHERE indexed_at IS NULL ORDER BY name").fetchall()
+            indexed = 0
+            for name, size, mtime_ns in pending:
+                try:
+                    summary = file_summary(os.path.join(self.directory, name))
+                except Exception as error:  # a broken or half-written file is indexed again once it changes
+                    logger.warning("cannot index %s: %s: %s", name, type(error).__name__, error)
+                    summary = {"snps": None, "harvester_snps": None, "max_lod": None, "averages": None}
+                with connection:
+                    # the file may have changed while it was read, then it stays pending
+                    indexed += connection.execute(
+                        "UPDATE files SET snps = ?, harvester_snps = ?, max_lod = ?, averages = ?, indexed_at = ? "
+                        "WHERE name = ? AND size = ? AND mtime_ns = ?",
+                        (summary["snps"], summary["harvester_snps"], summary["max_lod"], summary["averages"],
+                         time.time(), name, size, mtime_ns)).rowcount
+        finally:
+            connection.close()
+        return indexed
+
+    def files(self):
+        """Catalog entries (dictionaries with the columns of the files table), sorted by name."""
+        connection = self._connect()
+        connection.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in connection.execute("SELECT * FROM files ORDER BY name")]
+        finally:
+            connection.close()
+
+    def search(self, query, limit):
+        """
+        Entries (name, snps, harvester_snps and max_lod, see file_summary) of at most limit files whose name
+        contains query (case-insensitive): names starting with query first, then the other matches, each sorted by name.
+        """
+        pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        connection = self._connect()
+        connection.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in connection.execute(
+                "SELECT name, snps, harvester_snps, max_lod FROM files WHERE name LIKE ? ESCAPE '\\' "
+                "ORDER BY name NOT LIKE ? ESCAPE '\\', name LIMIT ?",
+                ("%" + pattern + "%", pattern + "%", limit))]
+        finally:
+            connection.close()
+
+    def __contains__(self, name):
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone() is not None
+        finally:
+            connection.close()
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.refresh()
+                self.index()
+            except Exception:  # e.g. the directory is temporarily unavailable on a network filesystem
+                logger.exception("refreshing the catalog of %s (%s) failed", self.directory, self.path)
+            time.sleep(interval)
+
+    def _run_process(self, interval):
+        # a forked process inherits the signal handlers of its parent (e.g. those of the gunicorn master),
+        # the default ones let it be terminated with its parent
+        for number in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT, signal.SIGCHLD):
+            signal.signal(number, signal.SIG_DFL)
+        self._run(interval)
+
+    def start(self, interval=refresh_interval):
+        """Refreshes and indexes the catalog every interval seconds in a background (daemon) thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="snip-catalog", daemon=True)
+            self._thread.start()
+
+    def start_process(self, interval=refresh_interval):
+        """
+        Refreshes and indexes the catalog every interval seconds in a separate (daemon) process, for
+        processes that fork later on (e.g. the gunicorn master of snip_serve), where a background
+        thread could be holding a lock at the time of a fork. Returns the process.
+        """
+        process = multiprocessing.Process(target=self._run_process, args=(interval,), name="snip-catalog", daemon=True)
+        process.start()
+        return process
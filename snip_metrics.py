@@ -0,0 +1,143 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+"""
+
+Lightweight timing instrumentation of the SNIP calling and the dashboard callbacks.
+
+Stages are timed with the timed context manager and recorded in histograms, which are rendered in the
+Prometheus text format by render (served by the dashboard on /metrics). Only the standard library is used,
+so snip_calling can be instrumented without extra dependencies.
+
+"""
+
+
+# upper bounds of the histogram buckets: stage durations in seconds and payload sizes in bytes
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))   # 1 KiB .. 256 MiB
+
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram of observed values, one series per label value.
+
+        Inputs:
+    name: metric name.
+    help: description of the metric.
+    label: name of the label distinguishing the series.
+    buckets: upper bounds of the buckets (+Inf is added).
+    """
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        """Lines of the Prometheus text format for this histogram."""
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = '%s="%s"' % (self.label, _escape(label_value))
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label, series["count"]))
+                lines.append("%s_sum{%s} %r" % (self.name, label, series["sum"]))
+                lines.append("%s_count{%s} %d" % (self.name, label, series["count"]))
+        return lines
+
+
+def _escape(value):
+    """Escapes a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+stage_seconds = Histogram("snip_stage_seconds", "Duration of the stages of loading, calling and drawing.",
+                          "stage", SECONDS_BUCKETS)
+request_seconds = Histogram("snip_request_seconds", "Duration of Dash callback requests by output.",
+                            "output", SECONDS_BUCKETS)
+payload_bytes = Histogram("snip_payload_bytes", "Size of Dash callback responses by output.",
+                          "output", BYTES_BUCKETS)
+
+# time spent in timed stages by the current thread, see request_started/request_finished
+_local = threading.local()
+
+
+@contextmanager
+def timed(stage):
+    """
+    Context manager recording the duration of its block in stage_seconds under the given stage
+    (prefixed, see stage_prefix). Stages may be nested, the duration of a stage then includes its nested stages.
+    """
+    stage = getattr(_local, "prefix", "") + stage
+    start = time.perf_counter()
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _local.depth -= 1
+        stage_seconds.observe(stage, elapsed)
+        if _local.depth == 0:
+            _local.staged = getattr(_local, "staged", 0.0) + elapsed
+
+
+@contextmanager
+def stage_prefix(prefix):
+    """
+    Context manager recording the stages timed by the current thread within its block under
+    prefix + stage (e.g. "catalog_read"), to keep background work apart from the stages of requests.
+    """
+    outer = getattr(_local, "prefix", "")
+    _local.prefix = prefix
+    try:
+        yield
+    finally:
+        _local.prefix = outer
+
+
+def request_started():
+    """Marks the start of a request handled by the current thread."""
+    _local.start = time.perf_counter()
+    _local.staged = 0.0
+
+
+def request_finished(output, nbytes):
+    """
+    Records the duration and response size of the current thread's request, and the time not
+    spent in timed stages as the "serialize" stage (JSON encoding of the outputs by Dash and
+    the rest of the request handling).
+    """
+    start = getattr(_local, "start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    request_seconds.observe(output, elapsed)
+    payload_bytes.observe(output, nbytes)
+    stage_seconds.observe("serialize", max(0.0, elapsed - _local.staged))
+    _local.start = None
+
+
+def render(extra_lines=()):
+    """All metrics in the Prometheus text format, followed by extra_lines."""
+    lines = []
+    for histogram in (stage_seconds, request_seconds, payload_bytes):
+        lines.extend(histogram.render())
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
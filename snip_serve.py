@@ -0,0 +1,111 @@
+import os
+import sys
+import argparse
+import importlib.util
+
+import snip_calling
+import dashboard
+from snip_catalog import Catalog
+
+
+"""
+
+Production serving of the SNIP calling dashboard: several worker processes behind the gunicorn WSGI server,
+instead of the single-process development server (app.run with the reloader) of dashboard.py.
+
+The workers share the parsed harv_processed files and the calling results instead of each holding its own copy:
+column stores are written for all files before the workers start, and for files added later when they are first
+loaded or indexed by the catalog (see snip_calling.column_store_on_load). They are memory-mapped by every worker (see
+snip_calling.read_column_store), so their pages live once in the OS page cache, and calling results are shared
+through a directory of Arrow files (snip_calling.result_store_dir).
+
+    python snip_serve.py --bind 0.0.0.0:8050 --workers 4 --threads 4
+
+The app is loaded in the gunicorn master before the workers are forked, with the catalog of harv_processed
+files refreshed once; the catalog is then kept up to date by a separate process started once the workers
+run (start_catalog), since a thread of the master could hold a lock while a worker is forked.
+
+gunicorn and pyarrow must be installed. The figure and table caches of the dashboard,
+and the /metrics counters, stay per worker.
+
+"""
+
+
+def gunicorn_application(app, options):
+    """
+    gunicorn application serving a Dash app, loaded once in the master process before the workers
+    are forked (preload_app), with the given gunicorn settings.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class SnipApplication(BaseApplication):
+
+        def load_config(self):
+            for name, value in options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return app.server
+
+    return SnipApplication()
+
+
+def start_catalog(server):
+    """gunicorn when_ready hook: keeps the catalog of the dashboard up to date in a separate process."""
+    dashboard.catalog.start_process()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the SNIP calling dashboard with several worker processes")
+    parser.add_argument("--bind", default="127.0.0.1:8050", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=min(8, 2 * (os.cpu_count() or 1)),
+                        help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker (default: %(default)s)")
+    parser.add_argument("--timeout", type=int, default=300,
+                        help="seconds before a silent worker is restarted, loading big files takes a while (default: %(default)s)")
+    parser.add_argument("--results", default=os.path.join(snip_calling.pathway, snip_calling.sidecar_dir, "results"),
+                        help="directory of the calling results shared by the workers (default: %(default)s)")
+    parser.add_argument("--render-mode", choices=("auto", "svg", "webgl"), default=dashboard.render_mode,
+                        help="draw the Manhattan plot with SVG, WebGL or pick per trace by its size (default: %(default)s)")
+    parser.add_argument("--profiles", default=snip_calling.profiles_path,
+                        help="JSON file with the genome profiles, see snip_calling.load_profiles (default: %(default)s)")
+    parser.add_argument("--catalog", default=dashboard.catalog.path,
+                        help="SQLite catalog of the harv_processed files shared by the workers, on a local filesystem (default: %(default)s)")
+    parser.add_argument("--layout", choices=("subplots", "cumulative"), default=dashboard.figure_layout,
+                        help="one subplot per chromosome, or all chromosomes on one x-axis (default: %(default)s)")
+    parser.add_argument("--figure-builder", choices=("dict", "plotly"), default=dashboard.figure_builder,
+                        help="assemble the figures as plain dictionaries, or with validating plotly graph objects (default: %(default)s)")
+    parser.add_argument("--cache-budget", type=float, default=snip_calling.cache_memory_budget / 1024 ** 3,
+                        help="memory (GiB) for parsed harv_processed files kept by each worker (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    for module in ("gunicorn", "pyarrow"):
+        if importlib.util.find_spec(module) is None:
+            print("%s is required for the production server: pip install %s" % (module, module), file=sys.stderr)
+            return 1
+
+    for f in snip_calling.convert_harv_processed(snip_calling.pathway):
+        print("converted", f, file=sys.stderr)
+
+    snip_calling.result_store_dir = args.results
+    snip_calling.column_store_on_load = True
+    snip_calling.parsed_files.max_size = int(args.cache_budget * 1024 ** 3)
+    snip_calling.load_profiles(args.profiles)
+    dashboard.render_mode = args.render_mode
+    dashboard.figure_layout = args.layout
+    dashboard.figure_builder = args.figure_builder
+    dashboard.catalog = Catalog(snip_calling.pathway, args.catalog)
+
+    app = dashboard.create_app(watch_catalog=False)
+    gunicorn_application(app, {"bind": args.bind,
+                               "workers": args.workers,
+                               "threads": args.threads,
+                               "worker_class": "gthread",
+                               "timeout": args.timeout,
+                               "preload_app": True,
+                               "when_ready": start_catalog}).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())